@@ -4,8 +4,18 @@ import sublime
 import sublime_plugin
 import logging
 import random
+import time
+import os
 
 from .src.client import client
+from .src.executor import LANE_META
+from .src.utils import show_report, get_setting
+from .src import recorder
+from .src import session
+from .src import memory
+from .src.buffers import DISPATCH
+from .src.soak import SoakRun
+from .src.profiler import SamplingProfiler
 from input_handlers import SimpleTextInput
 from input_handlers import SimpleListInput
 from input_handlers import ActiveWorkspacesIdList
@@ -30,7 +40,7 @@ class CodempConnectCommand(sublime_plugin.WindowCommand):
                     and your credentials are correct."
                 )
 
-        sublime.set_timeout_async(_)
+        client.executor.submit(LANE_META, _)
 
     def input_description(self):
         return "Server host:"
@@ -61,6 +71,8 @@ class CodempDisconnectCommand(sublime_plugin.WindowCommand):
         return client.codemp is not None
 
     def run(self):
+        # an explicit disconnect means we don't want this session back.
+        session.clear()
         client.disconnect()
 
 
@@ -88,8 +100,9 @@ class CodempJoinWorkspaceCommand(sublime_plugin.WindowCommand):
                 sublime.error_message(f"Could not join workspace '{workspace_id}'")
                 return
             client.install_workspace(workspace, active_window)
+            session.save(client)
 
-        sublime.set_timeout_async(_)
+        client.executor.submit(LANE_META, _)
         # the else shouldn't really happen, and if it does, it should already be instantiated.
         # ignore.
 
@@ -116,6 +129,7 @@ class CodempLeaveWorkspaceCommand(sublime_plugin.WindowCommand):
             vws = client.workspace_from_id(workspace_id)
             if vws is not None:
                 client.uninstall_workspace(vws)
+            session.save(client)
         else:
             logger.error(f"could not leave the workspace '{workspace_id}'")
 
@@ -186,3 +200,180 @@ class CodempDeleteWorkspaceCommand(sublime_plugin.WindowCommand):
         workspaces = client.codemp.list_workspaces(True, False)  # noqa: F841
         if "workspace_id" not in args:
             return SimpleListInput(("workspace_id", workspaces.wait()))
+
+
+# Restore Session Command
+class CodempRestoreSessionCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self) -> bool:
+        return client.codemp is None and session.load() is not None
+
+    def run(self, password):  # pyright: ignore[reportIncompatibleMethodOverride]
+        saved = session.load()
+        if saved is None:
+            return
+
+        # the first saved window goes in this one, new windows are opened
+        # for the others.
+        windows = [self.window]
+        for _ in saved["windows"][1:]:
+            sublime.run_command("new_window")
+            windows.append(sublime.active_window())
+
+        def _():
+            try:
+                session.restore(client, saved, windows, password)
+            except Exception as e:
+                logger.error(f"could not restore the session: {e}")
+                sublime.error_message("Could not restore the codemp session.")
+
+        client.executor.submit(LANE_META, _)
+
+    def input_description(self):
+        return "Password:"
+
+    def input(self, args):
+        if "password" not in args:
+            return SimpleTextInput(("password", "password?"))
+
+
+class CodempExecutorStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        lines = []
+        for lane, stats in client.executor.stats().items():
+            lines.append(
+                "{:<8} depth: {depth:<5} running: {running:<3} done: {completed:<8} "
+                "wait avg: {avg_wait_ms:.1f}ms max: {max_wait_ms:.1f}ms".format(
+                    lane, **stats
+                )
+            )
+
+        names = {vbuff.view.id(): vbuff.id for vbuff in client.all_buffers()}
+        buffers = client.executor.buffer_stats()
+        if buffers:
+            lines += ["", "edits by buffer:"]
+        for key, stats in sorted(buffers.items(), key=lambda i: -i[1]["completed"]):
+            lines.append(
+                "  {:<30} depth: {depth:<5} done: {completed:<8} share: {share:>4.0%} "
+                "wait avg: {avg_wait_ms:.1f}ms max: {max_wait_ms:.1f}ms".format(
+                    names.get(key, f"view {key}"), **stats
+                )
+            )
+        show_report(self.window, "codemp executor", "\n".join(lines) + "\n")
+
+
+class CodempMemoryReportCommand(sublime_plugin.WindowCommand):
+    def run(self, stop_tracing=False):
+        if stop_tracing:
+            memory.TRACKER.stop()
+            sublime.status_message("[codemp] stopped tracing allocations")
+            return
+        text = memory.report(client, len(DISPATCH))
+        show_report(self.window, "codemp memory", text)
+
+
+class CodempRecordStartCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return recorder.RECORDER is None
+
+    def run(self, path=None):  # pyright: ignore[reportIncompatibleMethodOverride]
+        if path is None:
+            folder = os.path.join(sublime.cache_path(), "codemp")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, time.strftime("recording-%Y%m%d-%H%M%S.cmprec"))
+        recorder.start_recording(path)
+        sublime.status_message(f"[codemp] recording to '{path}'")
+
+
+class CodempRecordStopCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return recorder.RECORDER is not None
+
+    def run(self):
+        rec = recorder.stop_recording()
+        if rec is not None:
+            sublime.status_message(f"[codemp] {rec.records} events saved to '{rec.path}'")
+
+
+class CodempReplayCommand(sublime_plugin.WindowCommand):
+    def run(self, path, speed=1.0):  # pyright: ignore[reportIncompatibleMethodOverride]
+        try:
+            speed = float(speed)
+        except ValueError:
+            sublime.error_message(f"Invalid replay speed '{speed}'")
+            return
+        recorder.Replayer(path, client, self.window, speed).start()
+
+    def input(self, args):
+        if "path" not in args:
+            return SimpleTextInput(("path", "recording.cmprec"), ("speed", "1.0"))
+
+        if "speed" not in args:
+            return SimpleTextInput(("speed", "1.0"))
+
+
+# Soak testing against the fake codemp server
+SOAK_RUN = None
+
+
+class CodempSoakCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        # the soak run takes over the client, it can't share it with a real session.
+        return client.codemp is None and SOAK_RUN is None
+
+    def run(self, minutes=60, **kwargs):  # pyright: ignore[reportIncompatibleMethodOverride]
+        global SOAK_RUN
+        SOAK_RUN = SoakRun(client, self.window, minutes * 60, **kwargs)
+        SOAK_RUN.start()
+        sublime.status_message(f"[codemp] soak run started for {minutes} minutes")
+
+
+class CodempSoakStopCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return SOAK_RUN is not None
+
+    def run(self):
+        global SOAK_RUN
+        if SOAK_RUN is not None:
+            SOAK_RUN.stop()
+            SOAK_RUN = None
+
+
+# Profiling
+PROFILER = None
+
+
+class CodempProfileStartCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return PROFILER is None
+
+    def run(self, interval_ms=None):  # pyright: ignore[reportIncompatibleMethodOverride]
+        global PROFILER
+        if interval_ms is None:
+            interval_ms = get_setting("profile_interval_ms", 5)
+        PROFILER = SamplingProfiler(interval_ms / 1000)
+        PROFILER.start()
+        sublime.status_message("[codemp] profiling...")
+
+
+class CodempProfileStopCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return PROFILER is not None
+
+    def run(self, path=None):  # pyright: ignore[reportIncompatibleMethodOverride]
+        global PROFILER
+        if PROFILER is None:
+            return
+        profiler, PROFILER = PROFILER, None
+        profiler.stop()
+
+        if path is None:
+            folder = os.path.join(sublime.cache_path(), "codemp")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+        profiler.write_collapsed(path)
+        logger.info(f"profile written to '{path}'")
+        show_report(
+            self.window,
+            "codemp profile",
+            f"collapsed stacks: {path}\n\n" + profiler.summary(),
+        )
@@ -59,10 +59,19 @@ class SimpleListInput(sublime_plugin.ListInputHandler):
 
 
 class ActiveWorkspacesIdList(sublime_plugin.ListInputHandler):
-    def __init__(self, window=None, buffer_list=False, buffer_text=False):
+    def __init__(
+        self,
+        window=None,
+        buffer_list=False,
+        buffer_text=False,
+        text_inputs=(),
+        user_list=False,
+    ):
         self.window = window
         self.buffer_list = buffer_list
         self.buffer_text = buffer_text
+        self.text_inputs = text_inputs
+        self.user_list = user_list
 
     def name(self):
         return "workspace_id"
@@ -75,6 +84,12 @@ class ActiveWorkspacesIdList(sublime_plugin.ListInputHandler):
             return BufferIdList(args["workspace_id"])
         elif self.buffer_text:
             return SimpleTextInput(("buffer_id", "new buffer"))
+        elif self.text_inputs:
+            return SimpleTextInput(*self.text_inputs)
+        elif self.user_list:
+            vws = client.workspace_from_id(args["workspace_id"])
+            users = sorted(vws.users - {client.user}) if vws is not None else []
+            return SimpleListInput(("user", users))
 
 
 # To allow for having a selection and choosing non existing workspaces
@@ -115,8 +130,7 @@ class BufferIdList(sublime_plugin.ListInputHandler):
     def __init__(self, workspace_id):
         vws = client.workspace_from_id(workspace_id)
         self.add_entry_text = "* create new..."
-        self.list = vws.codemp.filetree(None)
-        self.list.sort()
+        self.list = sorted(vws.filetree)
         self.list.append(self.add_entry_text)
         self.preselected = None
 
@@ -1,11 +1,10 @@
-import sublime
 import sublime_plugin
 import logging
 
 from .src.client import client
-from .src.utils import safe_listener_attach
-from .src.utils import safe_listener_detach
+from .src.utils import project_batch
 from .src import globals as g
+from .src import session
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +23,36 @@ class EventListener(sublime_plugin.EventListener):
     def on_pre_close_window(self, window):
         assert client.codemp is not None
 
-        for vws in client.all_workspaces(window):
-            client.codemp.leave_workspace(vws.id)
-            client.uninstall_workspace(vws)
+        with project_batch(), session.paused():
+            for vws in client.all_workspaces(window):
+                client.codemp.leave_workspace(vws.id)
+                client.uninstall_workspace(vws)
+
+    def on_load(self, view):
+        self.open_placeholder(view)
+
+    def on_activated(self, view):
+        self.open_placeholder(view)
+
+    def open_placeholder(self, view):
+        # an empty file standing in for a remote buffer was opened, we swap
+        # it for the real thing. goto anything previews are left alone.
+        filename = view.file_name()
+        if filename is None or view.settings().get(g.CODEMP_BUFFER_TAG):
+            return
+        sheet = view.sheet()
+        if sheet is not None and sheet.is_transient():
+            return
+        found = client.buffer_from_placeholder(filename)
+        if found is None:
+            return
+
+        vws, buffer_id = found
+        logger.debug(f"opened the placeholder of '{buffer_id}', attaching.")
+        view.close()
+        vws.window.run_command(
+            "codemp_join_buffer", {"workspace_id": vws.id, "buffer_id": buffer_id}
+        )
 
     def on_text_command(self, view, command_name, args):
         if command_name == "codemp_replace_text":
@@ -61,21 +87,20 @@ class CodempClientViewEventListener(sublime_plugin.ViewEventListener):
         vws.send_cursor(vbuff.id, start, end)
 
     def on_activated(self):
-        global TEXT_LISTENER
         logger.debug(f"'{self.view}' view activated!")
-        safe_listener_attach(TEXT_LISTENER, self.view.buffer())  # pyright: ignore
+        g.ACTIVE_CODEMP_VIEW = self.view.id()
+        vbuff = client.buffer_from_view(self.view)
+        if vbuff is not None:
+            vbuff.update_status()
 
     def on_deactivated(self):
-        global TEXT_LISTENER
         logger.debug(f"'{self.view}' view deactivated!")
-        safe_listener_detach(TEXT_LISTENER)  # pyright: ignore
+        if g.ACTIVE_CODEMP_VIEW == self.view.id():
+            g.ACTIVE_CODEMP_VIEW = None
+        # keep the selections and scroll positions of the session current.
+        session.save_soon(client)
 
     def on_pre_close(self):
-        if self.view == sublime.active_window().active_view():
-            logger.debug("closing active view")
-            global TEXT_LISTENER
-            safe_listener_detach(TEXT_LISTENER)  # pyright: ignore
-
         vws = client.workspace_from_view(self.view)
         vbuff = client.buffer_from_view(self.view)
         if vws is None or vbuff is None:
@@ -93,25 +118,3 @@ class CodempClientViewEventListener(sublime_plugin.ViewEventListener):
         if command_name == "codemp_replace_text":
             logger.info("got a codemp_replace_text command! but in the view listener")
 
-
-class CodempClientTextChangeListener(sublime_plugin.TextChangeListener):
-    @classmethod
-    def is_applicable(cls, buffer):  # pyright: ignore
-        # don't attach this event listener automatically
-        # we'll do it by hand with .attach(buffer).
-        return False
-
-    def on_text_changed(self, changes):
-        s = self.buffer.primary_view().settings()
-        if s.get(g.CODEMP_IGNORE_NEXT_TEXT_CHANGE, False):
-            logger.debug("Ignoring echoing back the change.")
-            s[g.CODEMP_IGNORE_NEXT_TEXT_CHANGE] = False
-            return
-
-        vbuff = client.buffer_from_view(self.buffer.primary_view())
-        if vbuff is not None:
-            logger.debug(f"local buffer change! {vbuff.id}")
-            vbuff.send_buffer_change(changes)
-
-
-TEXT_LISTENER = CodempClientTextChangeListener()
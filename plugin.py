@@ -2,22 +2,17 @@
 import sublime
 import sublime_plugin
 import logging
+import sys
+import time
 
-from .src.utils import safe_listener_detach
-from listeners import TEXT_LISTENER
+from .src.client import client
+from .src.buffers import VBUFFERS
+from .src.utils import get_setting, show_report
+from .src import globals as g
+from .src import session
 
-from client_commands import CodempConnectCommand
-from client_commands import CodempDisconnectCommand
-from client_commands import CodempCreateWorkspaceCommand
-from client_commands import CodempDeleteWorkspaceCommand
-from client_commands import CodempJoinWorkspaceCommand
-from client_commands import CodempLeaveWorkspaceCommand
-from client_commands import CodempInviteToWorkspaceCommand
-
-from workspace_commands import CodempCreateBufferCommand
-from workspace_commands import CodempDeleteBufferCommand
-from workspace_commands import CodempJoinBufferCommand
-from workspace_commands import CodempLeaveBufferCommand
+# The command modules (client_commands, workspace_commands, ...) are picked up
+# by sublime on its own, there is no need to import them from here.
 
 LOG_LEVEL = logging.DEBUG
 handler = logging.StreamHandler()
@@ -37,22 +32,69 @@ logger = logging.getLogger(__name__)
 # Initialisation and Deinitialisation
 ##############################################################################
 def plugin_loaded():
-    logger.debug("plugin loaded")
+    elapsed = time.perf_counter() - g.LOAD_STARTED
+    g.LOAD_TIMES["plugin"] = elapsed
+    logger.debug(f"plugin loaded in {elapsed * 1000:.1f}ms")
+
+    if "codemp" in sys.modules:
+        logger.warning("the codemp bindings were loaded at startup.")
+    budget = get_setting("load_time_budget_ms", 50)
+    if elapsed * 1000 > budget:
+        logger.warning(
+            f"plugin load took {elapsed * 1000:.1f}ms, over the budget of {budget}ms."
+        )
+
+    if get_setting("offer_session_restore", True) and session.load() is not None:
+        sublime.set_timeout(offer_session_restore, 500)
+
+
+def offer_session_restore():
+    saved = session.load()
+    if saved is None or client.codemp is not None:
+        return
+    if sublime.ok_cancel_dialog(
+        f"Restore the codemp session on '{saved['host']}' as '{saved['user']}'?",
+        ok_title="restore",
+        title="Restore Session?",
+    ):
+        sublime.active_window().run_command("codemp_restore_session")
 
 
 def plugin_unloaded():
     logger.debug("unloading")
-    safe_listener_detach(TEXT_LISTENER)
+    for vbuff in list(VBUFFERS.values()):
+        vbuff.detach_listener()
+    client.executor.shutdown()
     package_logger.removeHandler(handler)
     # client.disconnect()
 
 
+class CodempLoadReportCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        lines = [
+            f"plugin load:    {g.LOAD_TIMES.get('plugin', 0) * 1000:.1f}ms",
+            "codemp load:    "
+            + (
+                f"{g.LOAD_TIMES['codemp'] * 1000:.1f}ms"
+                if "codemp" in g.LOAD_TIMES
+                else "not loaded yet"
+            ),
+            f"loaded eagerly: {'codemp' in sys.modules and 'codemp' not in g.LOAD_TIMES}",
+        ]
+        show_report(self.window, "codemp load report", "\n".join(lines) + "\n")
+
+
 # Text Change Command
 #############################################################################
 class CodempReplaceTextCommand(sublime_plugin.TextCommand):
-    def run(self, edit, start, end, content, change_id):
+    def run(self, edit, start, end, content, change_id, local=False):
         # we modify the region to account for any change that happened in the mean time
         region = self.view.transform_region_from(sublime.Region(start, end), change_id)
+        # so that the text listener knows this change is ours, not the user's.
+        # `local` changes are meant to be picked up and sent like typing.
+        vbuff = VBUFFERS.get(self.view.buffer_id())
+        if vbuff is not None and not local:
+            vbuff.applied(region.begin(), region.end(), content)
         self.view.replace(edit, region, content)
 
 
@@ -1,48 +1,153 @@
 from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional
+from collections import deque
 
 import sublime
-import os
+import sublime_plugin
+import threading
 import logging
+import time
+import os
 
 from . import globals as g
 from .utils import populate_view, safe_listener_attach, safe_listener_detach
-import codemp
+from .utils import track_instance, rebase_changes, get_setting
+from .utils import apply_edits, minimal_edits, path_within
+from .cursors import RemoteCursors
+from .executor import PriorityExecutor, LANE_EDITS, LANE_META
+from .search import TrigramIndex
+from .latency import RttEstimator
+from . import recorder
+
+if TYPE_CHECKING:
+    import codemp
 
 logger = logging.getLogger(__name__)
 
+
+def send_edits(buffctl: codemp.BufferController, edits):
+    # sends non overlapping edits, all relative to the same text, as one
+    # ordered group: the last one first so that the positions of the others
+    # stay valid. the sends are pipelined and only the group is waited on.
+    promises = [
+        buffctl.send(start, end, text) for start, end, text in sorted(edits, reverse=True)
+    ]
+    for promise in promises:
+        promise.wait()
+
+
+def include(local, remote):
+    # two concurrent changes over the same text: `local` not sent yet,
+    # `remote` already applied by the server. returns `remote` over the text
+    # `local` left and `local` over the text `remote` left, so both orders
+    # end the same. where they overlap, everything either one deleted stays
+    # deleted and both texts are kept, the one starting first in front.
+    ls, le, lt = local
+    rs, re_, rt = remote
+    dl = len(lt) - (le - ls)
+    dr = len(rt) - (re_ - rs)
+    if le <= rs and not ls == le == rs:
+        return (rs + dl, re_ + dl, rt), local
+    if ls >= re_:
+        return remote, (ls + dr, le + dr, lt)
+    end = max(le, re_)
+    if ls <= rs:
+        return (ls + len(lt), end + dl, rt), (ls, end + dr, lt + rt)
+    return (rs, end + dl, rt + lt), (rs + len(rt), end + dr, lt)
+
+
+# The edits the plugin itself makes to a buffer, in the order they were made.
+# The text listener hears about them like any other change: matching them
+# here, in order and by exact region and text, tells them apart from the
+# user's own typing however they interleave.
+class EchoLedger:
+    LIMIT = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._applied: deque[tuple[int, int, str]] = deque()
+
+    def expect(self, begin: int, end: int, content: str):
+        if begin == end and not content:
+            return  # sublime does not report a change for this.
+        with self._lock:
+            if len(self._applied) >= self.LIMIT:
+                logger.warning("echo ledger overflowing, dropping the oldest entry.")
+                self._applied.popleft()
+            self._applied.append((begin, end, content))
+
+    def consume(self, begin: int, end: int, content: str) -> bool:
+        # changes are reported in the order they happened, so anything ahead
+        # of a match was never reported (e.g. replacing text with itself).
+        with self._lock:
+            try:
+                index = self._applied.index((begin, end, content))
+            except ValueError:
+                return False
+            for _ in range(index + 1):
+                self._applied.popleft()
+            return True
+
+    def __len__(self) -> int:
+        return len(self._applied)
+
+
+# sublime buffer id -> the codemp buffer shown in it, known from the moment
+# the view exists, before the client has registered it.
+VBUFFERS: dict[int, VirtualBuffer] = {}
+
+
+# Local changes of every attached buffer, queued by their listeners and
+# handed over in one go from the main thread, so that a listener only has
+# to append to a list and many busy buffers cost one callback per batch.
+# Each call of a listener stays its own batch, in the order they came:
+# they are never merged, so echoes are matched against exactly what
+# sublime reported together with them.
+class ChangeDispatch:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: list[tuple[int, list]] = []
+        self._scheduled = False
+
+    def push(self, buffer_id: int, changes: list):
+        with self._lock:
+            self._pending.append((buffer_id, changes))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        sublime.set_timeout(self.drain)
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._scheduled = False
+
+        for buffer_id, changes in pending:
+            vbuff = VBUFFERS.get(buffer_id)
+            if vbuff is not None:
+                vbuff.local_changes(changes)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+DISPATCH = ChangeDispatch()
+
+
+class CodempClientTextChangeListener(sublime_plugin.TextChangeListener):
+    @classmethod
+    def is_applicable(cls, buffer):  # pyright: ignore
+        # don't attach this event listener automatically
+        # we'll do it by hand with .attach(buffer).
+        return False
+
+    def on_text_changed(self, changes):
+        DISPATCH.push(self.buffer.id(), changes)
+
+
 def make_bufferchange_cb(buff: VirtualBuffer):
     def __callback(bufctl: codemp.BufferController):
-        def _():
-            change_id = buff.view.change_id()
-            while change := bufctl.try_recv().wait():
-                logger.debug("received remote buffer change!")
-                if change is None:
-                    break
-
-                if change.is_empty():
-                    logger.debug("change is empty. skipping.")
-                    continue
-
-                # In case a change arrives to a background buffer, just apply it.
-                # We are not listening on it. Otherwise, interrupt the listening
-                # to avoid echoing back the change just received.
-                if buff.view.id() == g.ACTIVE_CODEMP_VIEW:
-                    buff.view.settings()[g.CODEMP_IGNORE_NEXT_TEXT_CHANGE] = True
-
-                # we need to go through a sublime text command, since the method,
-                # view.replace needs an edit token, that is obtained only when calling
-                # a textcommand associated with a view.
-                buff.view.run_command(
-                    "codemp_replace_text",
-                    {
-                        "start": change.start,
-                        "end": change.end,
-                        "content": change.content,
-                        "change_id": change_id,
-                    },  # pyright: ignore
-                )
-
-        sublime.set_timeout(_)
+        buff.executor.submit_for(buff.view.id(), LANE_EDITS, buff.receive)
     return __callback
 
 
@@ -51,25 +156,78 @@ class VirtualBuffer:
         self,
         buffctl: codemp.BufferController,
         view: sublime.View,
-        rootdir: str,
+        rootdir: Optional[str],
+        executor: PriorityExecutor,
+        rtt: RttEstimator,
     ):
         self.buffctl = buffctl
         self.view = view
+        self.executor = executor
+        self.rtt = rtt
         self.id = self.buffctl.path()
 
-        self.tmpfile = os.path.join(rootdir, self.id)
-        open(self.tmpfile, "a").close()
-
         self.view.set_scratch(True)
         self.view.set_name(self.id)
-        self.view.retarget(self.tmpfile)
-
+        # tagged before it is retargeted: from then on it looks like the
+        # placeholder of this buffer, and would be swapped for a new view.
         self.view.settings().set(g.CODEMP_BUFFER_TAG, True)
+
+        self.tmpfile = None
+        if rootdir is not None:
+            self.tmpfile = path_within(rootdir, self.id)
+            if self.tmpfile is None:
+                logger.warning(
+                    f"'{self.id}' points outside the workspace, keeping it in memory."
+                )
+
+        if self.tmpfile is None:
+            # purely virtual buffer, nothing touches the disk. we still want the
+            # syntax that the file extension would give us.
+            syntax = sublime.find_syntax_for_file(self.id)
+            if syntax is not None:
+                self.view.assign_syntax(syntax)
+        else:
+            os.makedirs(os.path.dirname(self.tmpfile), exist_ok=True)
+            open(self.tmpfile, "a").close()
+            self.view.retarget(self.tmpfile)
+
+        self.ledger = EchoLedger()
+        # every buffer listens to its own changes, active or not, so that
+        # edits made by other plugins to background views are sent too.
+        self.listener = CodempClientTextChangeListener()
+
         self.view.set_status(g.SUBLIME_STATUS_ID, "[Codemp]")
+        self.cursors = RemoteCursors(self.view)
+        VBUFFERS[self.view.buffer_id()] = self
+        # the search index of the workspace, if any, to be told about changes.
+        self.index: Optional[TrigramIndex] = None
+
+        # local changes waiting for the current batching window to close.
+        self._outbox: list[tuple[int, int, str]] = []
+        self._outbox_lock = threading.Lock()
+        self._flush_scheduled = False
+        # batches of remote changes received but not applied to the view yet.
+        self._unapplied = 0
+
+        # what the server has, as far as we know: a base text and the changes
+        # sent or received since. it is only brought up to date, on the edits
+        # lane, when a large replacement needs the text it replaced.
+        self._shadow = ""
+        self._shadow_changes: list[tuple[int, int, str]] = []
+
+        # recent remote changes, to notice bursts of them.
+        self._remote_times: deque[float] = deque()
+        self._burst_syntax: Optional[str] = None
+        self._burst_last = 0.0
+        self.in_burst = False
+
+        # remote changes wait in the controller until the view has its content.
+        self.synced = False
 
         logger.info(f"registering a callback for buffer: {self.id}")
         self.buffctl.callback(make_bufferchange_cb(self))
         self.isactive = True
+        track_instance(self)
 
     def __del__(self):
         logger.debug("__del__ buffer called.")
@@ -81,9 +239,18 @@ class VirtualBuffer:
         logger.info(f"clearing a callback for buffer: {self.id}")
         self.buffctl.clear_callback()
         self.buffctl.stop()
+        self.detach_listener()
         self.isactive = False
+        self.cursors.clear()
+        self.executor.forget(self.view.id())
+        if VBUFFERS.get(self.view.buffer_id()) is self:
+            del VBUFFERS[self.view.buffer_id()]
 
-        os.remove(self.tmpfile)
+        if self.tmpfile is not None:
+            try:
+                os.remove(self.tmpfile)
+            except OSError as e:
+                logger.warning(f"could not remove '{self.tmpfile}': {e}")
 
         def onclose(did_close):
             if did_close:
@@ -93,27 +260,283 @@ class VirtualBuffer:
 
         self.view.close(onclose)
 
-    def sync(self, text_listener):
+    def detach_listener(self):
+        safe_listener_detach(self.listener)
+
+    def sync(
+        self,
+        then: Optional[Callable[[VirtualBuffer], None]] = None,
+        failed: Optional[Callable[[VirtualBuffer], None]] = None,
+    ):
+        # the content is waited for on the meta lane, the edits lane of the
+        # buffer only ever runs the (quick) population of the view.
         promise = self.buffctl.content()
 
-        def _():
-            content = promise.wait()
-            safe_listener_detach(text_listener)
+        def populate(content: str):
+            # attached first, so the ledger entry of the content is consumed.
+            safe_listener_attach(self.listener, self.view.buffer())
             populate_view(self.view, content)
-            safe_listener_attach(text_listener, self.view.buffer())
+            with self._outbox_lock:
+                self._shadow = content
+                self._shadow_changes = []
+            self.synced = True
+            # whatever arrived while we were waiting for the content.
+            self.receive()
+            if then is not None:
+                sublime.set_timeout(lambda: then(self))
+
+        def fetch():
+            try:
+                content = promise.wait()
+            except Exception as e:
+                logger.error(f"could not fetch the content of '{self.id}': {e}")
+                if failed is not None:
+                    sublime.set_timeout(lambda: failed(self))
+                return
+            self.executor.submit_for(self.view.id(), LANE_EDITS, populate, content)
+
+        self.executor.submit(LANE_META, fetch)
+
+    def receive(self):
+        if not self.synced:
+            return  # the view is populated first, then this runs.
+        # our own pending changes go out first, they happened before
+        # anything we are about to receive was applied to the view.
+        self.flush()
+        changes = []
+        while change := self.buffctl.try_recv().wait():
+            logger.debug("received remote buffer change!")
+            if change is None:
+                break
+
+            if change.is_empty():
+                logger.debug("change is empty. skipping.")
+                continue
+
+            if recorder.RECORDER is not None:
+                recorder.RECORDER.remote_change(
+                    self.id, change.start, change.end, change.content
+                )
+
+            changes.append((change.start, change.end, change.content))
+
+        if changes:
+            # nothing more is sent until these are applied: the outbox is
+            # rewritten over them, and the server has to get it that way.
+            with self._outbox_lock:
+                self._unapplied += 1
+            # only the controller is touched here, the view on the main thread.
+            sublime.set_timeout(lambda: self.apply_changes(changes))
+
+    def apply_changes(self, changes: list[tuple[int, int, str]]):
+        # remote changes are relative to what the server has, the view also
+        # holds our local changes that are not sent yet. every remote change
+        # is moved past them before it is applied, and they are moved past it.
+        # whatever the listener heard but did not hand over yet goes first.
+        DISPATCH.drain()
+        for remote in changes:
+            with self._outbox_lock:
+                self._shadow_changes.append(remote)
+                outbox = []
+                for local in self._outbox:
+                    remote, local = include(local, remote)
+                    outbox.append(local)
+                self._outbox = outbox
+            if self.isactive:
+                self.apply_change(*remote, self.view.change_id())
+
+        with self._outbox_lock:
+            self._unapplied -= 1
+            resume = not self._unapplied and self._outbox and not self._flush_scheduled
+            if resume:
+                self._flush_scheduled = True
+        if resume:
+            self.executor.submit_for(self.view.id(), LANE_EDITS, self.flush)
+
+    def update_status(self):
+        status = self.rtt.status()
+        if self.in_burst:
+            status += " · burst"
+        self.view.set_status(g.SUBLIME_STATUS_ID, status)
+
+    def note_remote_change(self):
+        now = time.monotonic()
+        self._burst_last = now
+        if self.in_burst:
+            return
+
+        window = get_setting("burst_window_ms", 1000) / 1000
+        self._remote_times.append(now)
+        while self._remote_times and self._remote_times[0] < now - window:
+            self._remote_times.popleft()
+        if len(self._remote_times) < get_setting("burst_changes", 50):
+            return
+        if self.view.size() < get_setting("burst_min_size", 100000):
+            return
+
+        self.in_burst = True
+        self._remote_times.clear()
+        sublime.set_timeout(self._enter_burst)
 
-        sublime.set_timeout_async(_)
+    def _enter_burst(self):
+        # re-tokenising and laying out annotations after every remote change
+        # is what makes a big file crawl, so both wait for the burst to end.
+        logger.debug(f"'{self.id}' is taking a burst of remote changes")
+        self._burst_syntax = self.view.settings().get("syntax")
+        self.view.assign_syntax("Packages/Text/Plain text.tmLanguage")
+        self.cursors.set_burst(True)
+        self.update_status()
+        self._check_burst()
 
-    def send_buffer_change(self, changes):
+    def _check_burst(self):
+        if not self.isactive:
+            return
+        quiet = get_setting("burst_quiet_ms", 1500) / 1000
+        remaining = self._burst_last + quiet - time.monotonic()
+        if remaining > 0:
+            sublime.set_timeout(self._check_burst, int(remaining * 1000) + 1)
+            return
+
+        logger.debug(f"burst of remote changes on '{self.id}' is over")
+        if self._burst_syntax is not None:
+            self.view.assign_syntax(self._burst_syntax)
+            self._burst_syntax = None
+        self.cursors.set_burst(False)
+        self.in_burst = False
+        self.update_status()
+
+    def apply_change(self, start: int, end: int, content: str, change_id):
+        # applies a change that did not originate in the view, with offsets
+        # relative to the view as it was at `change_id`.
+        # we need to go through a sublime text command, since the method,
+        # view.replace needs an edit token, that is obtained only when calling
+        # a textcommand associated with a view.
+        self.view.run_command(
+            "codemp_replace_text",
+            {
+                "start": start,
+                "end": end,
+                "content": content,
+                "change_id": change_id,
+            },  # pyright: ignore
+        )
+        if self.index is not None:
+            self.index.invalidate(self.id)
+        self.note_remote_change()
+
+    def applied(self, begin: int, end: int, content: str):
+        # an edit the plugin is about to make to the view on codemp's behalf.
+        self.ledger.expect(begin, end, content)
+        self.cursors.shift([(begin, end, len(content))])
+
+    def shadow(self) -> str:
+        # the changes are applied outside of the lock, the main thread
+        # only ever appends to them.
+        with self._outbox_lock:
+            base, changes = self._shadow, list(self._shadow_changes)
+        if not changes:
+            return base
+        text = apply_edits(base, rebase_changes(changes))
+        with self._outbox_lock:
+            self._shadow = text
+            del self._shadow_changes[: len(changes)]
+        return text
+
+    def note_sent(self, edits: list[tuple[int, int, str]]):
+        # non overlapping edits, all relative to the same text, that the
+        # server applied: last to first, each leaves the others valid.
+        with self._outbox_lock:
+            self._shadow_changes.extend(sorted(edits, reverse=True))
+
+    def refine(self, pending: list[tuple[int, int, str]]) -> list[tuple[int, int, str]]:
+        # formatters, sorting or pasting over a selection replace a large
+        # region at once: those are diffed against what they replaced and
+        # only what actually changed is sent.
+        threshold = get_setting("diff_threshold", 4096)
+        big = [
+            i
+            for i, (begin, end, text) in enumerate(pending)
+            if end - begin >= threshold and len(text) >= threshold
+        ]
+        if not big:
+            return pending
+
+        max_lines = get_setting("diff_max_lines", 1000)
+        text = self.shadow()
+        refined: list[tuple[int, int, str]] = []
+        for begin, end, content in pending[: big[-1] + 1]:
+            if end - begin >= threshold and len(content) >= threshold:
+                edits = minimal_edits(
+                    text[begin:end], content, begin, max_lines=max_lines
+                )
+                logger.debug(
+                    f"replacement of {end - begin} characters sent as {len(edits)} edits"
+                )
+                # applied last to first, each leaves the offsets of the others valid.
+                refined.extend(reversed(edits))
+            else:
+                refined.append((begin, end, content))
+            text = text[:begin] + content + text[end:]
+        return refined + pending[big[-1] + 1 :]
+
+    def local_changes(self, changes):
+        # changes heard by the listener, minus the ones we made ourselves.
+        local: list[tuple[int, int, str]] = []
+        echoed = 0
+        for c in changes:
+            begin, end, text = c.a.pt, c.b.pt, c.str
+            if self.ledger.consume(begin, end, text):
+                echoed += 1
+            else:
+                local.append((begin, end, text))
+
+        if echoed:
+            logger.debug(f"Ignoring {echoed} echoed changes.")
+        if not local:
+            return
+
+        logger.debug(f"local buffer change! {self.id}")
+        self.cursors.shift([(begin, end, len(text)) for begin, end, text in local])
+        self.send_buffer_change(local)
+
+    def send_buffer_change(self, changes: list[tuple[int, int, str]]):
+        if self.index is not None:
+            self.index.invalidate(self.id)
         # we do not do any index checking, and trust sublime with providing the correct
         # sequential indexing, assuming the changes are applied in the order they are received.
-        for change in changes:
-            region = sublime.Region(change.a.pt, change.b.pt)
-            logger.debug(
-                "sending txt change: Reg({} {}) -> '{}'".format(
-                    region.begin(), region.end(), change.str
-                )
-            )
+        with self._outbox_lock:
+            for begin, end, text in changes:
+                if recorder.RECORDER is not None:
+                    recorder.RECORDER.local_change(self.id, begin, end, text)
+                self._outbox.append((begin, end, text))
+
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        # the changes are held back for a window that follows the round-trip
+        # time, so that fast typing on a slow link goes out in fewer batches.
+        sublime.set_timeout(
+            lambda: self.executor.submit_for(self.view.id(), LANE_EDITS, self.flush),
+            int(self.rtt.edit_window() * 1000),
+        )
+
+    def flush(self):
+        with self._outbox_lock:
+            self._flush_scheduled = False
+            if self._unapplied:
+                return  # resumed once the remote changes are applied.
+            pending, self._outbox = self._outbox, []
+        if not pending or not self.isactive:
+            return
 
-            # we must block and wait the send request to make sure the change went through ok
-            self.buffctl.send(region.begin(), region.end(), change.str).wait()
+        edits = rebase_changes(self.refine(pending))
+        logger.debug(f"sending {len(pending)} txt changes as {len(edits)} edits")
+        # we must block and wait the send request to make sure the change went through ok
+        sent_at = time.monotonic()
+        send_edits(self.buffctl, edits)
+        self.rtt.observe(time.monotonic() - sent_at)
+        self.note_sent(edits)
+        if len(self._shadow_changes) > 256:
+            self.shadow()
+        sublime.set_timeout(self.update_status)
@@ -0,0 +1,337 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import sublime
+import fnmatch
+import hashlib
+import codecs
+import threading
+import logging
+import json
+import time
+import re
+import os
+
+from .utils import get_setting, get_contents, path_within
+from .buffers import send_edits
+from .executor import LANE_EDITS
+
+if TYPE_CHECKING:
+    from .workspace import VirtualWorkspace
+
+logger = logging.getLogger(__name__)
+
+EXPORT_MANIFEST = ".codemp-export.json"
+WRITE_CHUNK = 64 * 1024
+BINARY_SNIFF = 8 * 1024
+
+
+def in_background(name: str, job: Callable[[], None]):
+    # bulk jobs run for as long as the workspace is big: they get a thread
+    # of their own, so that the meta lane stays free for short calls.
+    def _():
+        try:
+            job()
+        except Exception as e:
+            logger.exception(f"{name} failed: {e}")
+
+    threading.Thread(target=_, name=f"codemp-{name}", daemon=True).start()
+
+
+class BulkReport:
+    def __init__(self, action: str):
+        self.action = action
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.matches = 0
+        self.removed = 0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def done(self) -> BulkReport:
+        self.elapsed = time.perf_counter() - self.start
+        return self
+
+    def __str__(self) -> str:
+        elapsed = max(self.elapsed, 1e-6)
+        matches = f"{self.matches} matches, " if self.matches else ""
+        removed = f", {self.removed} removed" if self.removed else ""
+        return (
+            f"{matches}{self.action} {self.files} files ({self.bytes / 1e6:.2f}MB), "
+            f"{self.skipped} skipped{removed}, {self.failed} failed in {elapsed:.2f}s: "
+            f"{self.files / elapsed:.1f} files/s, {self.bytes / 1e6 / elapsed:.2f}MB/s"
+        )
+
+
+def _encoded(content: str) -> Iterator[bytes]:
+    # the utf-8 of a buffer a chunk at a time, never all of it at once.
+    encoder = codecs.getincrementalencoder("utf-8")()
+    for i in range(0, len(content), WRITE_CHUNK):
+        yield encoder.encode(content[i : i + WRITE_CHUNK])
+    yield encoder.encode("", final=True)
+
+
+def _digest(content: str) -> tuple[str, int]:
+    digest, size = hashlib.sha256(), 0
+    for chunk in _encoded(content):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _write_streamed(path: str, content: str):
+    # write next to the target and swap it in, so an interrupted export
+    # never leaves a half written file behind.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".part"
+    with open(partial, "wb") as f:
+        for chunk in _encoded(content):
+            f.write(chunk)
+    os.replace(partial, path)
+
+
+def export_workspace(
+    vws: VirtualWorkspace, directory: str, incremental: bool = True
+) -> BulkReport:
+    report = BulkReport("exported")
+    root = os.path.realpath(directory)
+    manifest_path = os.path.join(root, EXPORT_MANIFEST)
+
+    # read even for a full export: it tells which files a previous
+    # export left behind for buffers that are gone since.
+    manifest: dict[str, str] = {}
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"ignoring unreadable export manifest: {e}")
+
+    paths = sorted(vws.filetree)
+    fetched = 0
+    for path, content in vws.fetch_contents(paths):
+        fetched += 1
+        target = path_within(root, path)
+        if target is None:
+            logger.warning(f"refusing to export '{path}' outside of '{root}'")
+            report.failed += 1
+            continue
+        if target in (manifest_path, manifest_path + ".part"):
+            logger.warning(f"refusing to export '{path}' over the export manifest")
+            report.failed += 1
+            continue
+
+        digest, size = _digest(content)
+        if incremental and manifest.get(path) == digest and os.path.isfile(target):
+            report.skipped += 1
+            continue
+
+        try:
+            _write_streamed(target, content)
+        except OSError as e:
+            logger.error(f"could not export '{path}': {e}")
+            report.failed += 1
+            continue
+        manifest[path] = digest
+        report.files += 1
+        report.bytes += size
+
+    report.failed += len(paths) - fetched
+
+    existing = set(paths)
+    for path in [p for p in manifest if p not in existing]:
+        del manifest[path]
+        if _remove_exported(root, path):
+            report.removed += 1
+
+    # swapped in whole, like the files, so a crash never leaves half of it.
+    os.makedirs(root, exist_ok=True)
+    with open(manifest_path + ".part", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".part", manifest_path)
+
+    return report.done()
+
+
+def _remove_exported(root: str, path: str) -> bool:
+    # removes the file of a buffer that no longer exists, and the folders
+    # it leaves empty, never anything outside of the export.
+    target = path_within(root, path)
+    manifest_path = os.path.join(root, EXPORT_MANIFEST)
+    if target is None or target in (manifest_path, manifest_path + ".part"):
+        return False
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        logger.warning(f"could not remove the export of '{path}': {e}")
+        return False
+
+    folder = os.path.dirname(target)
+    while folder != root:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break  # not empty.
+        folder = os.path.dirname(folder)
+    return True
+
+
+def _ignored(relpath: str, patterns: list[str]) -> bool:
+    parts = relpath.split("/")
+    return any(
+        fnmatch.fnmatch(relpath, pat) or any(fnmatch.fnmatch(p, pat) for p in parts)
+        for pat in patterns
+    )
+
+
+def _read_text(path: str, max_size: int) -> Optional[str]:
+    # None for anything we should not share: too big, binary or not utf-8.
+    if os.path.getsize(path) > max_size:
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    if b"\0" in data[:BINARY_SNIFF]:
+        return None
+    try:
+        return data.decode()
+    except UnicodeDecodeError:
+        return None
+
+
+def share_folder(
+    vws: VirtualWorkspace,
+    directory: str,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> BulkReport:
+    report = BulkReport("shared")
+    patterns = get_setting("share_ignore_patterns", [])
+    max_size = get_setting("share_max_file_size", 1024 * 1024)
+    existing = set(vws.filetree)
+
+    files: list[tuple[str, str]] = []
+    for root, dirs, names in os.walk(directory):
+        reldir = os.path.relpath(root, directory).replace(os.sep, "/")
+        reldir = "" if reldir == "." else reldir + "/"
+        # prune ignored directories so we never descend into them.
+        dirs[:] = [d for d in dirs if not _ignored(reldir + d, patterns)]
+        for name in names:
+            relpath = reldir + name
+            if _ignored(relpath, patterns) or relpath in existing:
+                report.skipped += 1
+                continue
+            files.append((relpath, os.path.join(root, name)))
+
+    # every file goes through create -> attach -> upload -> detach,
+    # with a bounded number of files in flight at any time.
+    def upload(buffer_id: str, path: str) -> int:
+        content = _read_text(path, max_size)
+        if content is None:
+            return -1
+
+        vws.codemp.create(buffer_id).wait()
+        buffctl = vws.codemp.attach(buffer_id).wait()
+        try:
+            buffctl.send(0, 0, content).wait()
+        finally:
+            vws.codemp.detach(buffer_id)
+        return len(content.encode())
+
+    total = len(files)
+    with ThreadPoolExecutor(max_workers=get_setting("bulk_concurrency", 8)) as pool:
+        futures = {pool.submit(upload, *f): f[0] for f in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                size = future.result()
+            except Exception as e:
+                logger.warning(f"could not share '{futures[future]}': {e}")
+                report.failed += 1
+            else:
+                if size < 0:
+                    report.skipped += 1
+                else:
+                    report.files += 1
+                    report.bytes += size
+            if on_progress is not None:
+                on_progress(done, total)
+
+    return report.done()
+
+
+def replace_in_workspace(
+    vws: VirtualWorkspace,
+    pattern: str,
+    replacement: str,
+    regex: bool = False,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> BulkReport:
+    report = BulkReport("changed")
+    compiled = re.compile(pattern if regex else re.escape(pattern))
+
+    def edits_for(text: str) -> list[tuple[int, int, str]]:
+        if regex:
+            return [(m.start(), m.end(), m.expand(replacement)) for m in compiled.finditer(text)]
+        return [(m.start(), m.end(), replacement) for m in compiled.finditer(text)]
+
+    # attached buffers are edited on their own lane, after whatever we have
+    # not sent yet: the edits go out as one batch and are applied to the view
+    # the same way remote changes are.
+    def in_view(vbuff, future: Future):
+        try:
+            vbuff.flush()
+            change_id = vbuff.view.change_id()
+            edits = edits_for(get_contents(vbuff.view))
+            if edits:
+                send_edits(vbuff.buffctl, edits)
+                vbuff.note_sent(edits)
+
+                def apply():
+                    for start, end, text in sorted(edits, reverse=True):
+                        vbuff.apply_change(start, end, text, change_id)
+
+                sublime.set_timeout(apply)
+            future.set_result(edits)
+        except Exception as e:
+            future.set_exception(e)
+
+    def replace(path: str) -> list[tuple[int, int, str]]:
+        vbuff = vws.buff_by_id(path)
+        if vbuff is not None:
+            future: Future = Future()
+            vws.executor.submit_for(vbuff.view.id(), LANE_EDITS, in_view, vbuff, future)
+            return future.result()
+
+        buffctl = vws.codemp.attach(path).wait()
+        try:
+            edits = edits_for(buffctl.content().wait())
+            if edits:
+                send_edits(buffctl, edits)
+        finally:
+            if vws.buff_by_id(path) is None:
+                vws.codemp.detach(path)
+        return edits
+
+    paths = sorted(vws.filetree)
+    with ThreadPoolExecutor(max_workers=get_setting("bulk_concurrency", 8)) as pool:
+        futures = {pool.submit(replace, path): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                edits = future.result()
+            except Exception as e:
+                logger.warning(f"could not replace in '{futures[future]}': {e}")
+                report.failed += 1
+            else:
+                if edits:
+                    report.files += 1
+                    report.matches += len(edits)
+                    report.bytes += sum(len(text.encode()) for _, _, text in edits)
+                else:
+                    report.skipped += 1
+            if on_progress is not None:
+                on_progress(done, len(paths))
+
+    return report.done()
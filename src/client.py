@@ -1,17 +1,48 @@
 from __future__ import annotations
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 
 import sublime
 import logging
+import time
 
-import codemp
+from . import globals as g
+from . import session
 from .workspace import VirtualWorkspace
 from .buffers import VirtualBuffer
-from .utils import bidict
+from .executor import PriorityExecutor
+from .latency import RttEstimator
+from .utils import bidict, project_batch, track_instance
+
+if TYPE_CHECKING:
+    import codemp
 
 logger = logging.getLogger(__name__)
 
+# a module standing in for the codemp bindings, see `fake_codemp`.
+_backend = None
+
+
+def use_backend(module):
+    global _backend
+    _backend = module
+
+
+def load_codemp():
+    if _backend is not None:
+        return _backend
+
+    # the native bindings are expensive to load and most sessions never
+    # connect, so we only pull them in the first time they are needed.
+    start = time.perf_counter()
+    import codemp
+
+    if "codemp" not in g.LOAD_TIMES:
+        g.LOAD_TIMES["codemp"] = time.perf_counter() - start
+        logger.debug(f"codemp loaded in {g.LOAD_TIMES['codemp'] * 1000:.1f}ms")
+    return codemp
+
+
 # the client will be responsible to keep track of everything!
 # it will need 3 bidirectional dictionaries and 2 normal ones
 # normal: workspace_id -> VirtualWorkspaces
@@ -25,6 +56,11 @@ class VirtualClient:
     def __init__(self):
         self.codemp: Optional[codemp.Client] = None
         self.driver: Optional[codemp.Driver] = None
+        self.executor = PriorityExecutor()
+        self.rtt = RttEstimator()
+        self.host: Optional[str] = None
+        self.stand_in = False
+        self.user: Optional[str] = None
 
         # bookkeeping corner
         self._id2buffer: dict[str, VirtualBuffer] = {}
@@ -33,6 +69,7 @@ class VirtualClient:
         self._view2buff: dict[sublime.View, VirtualBuffer] = {}
         self._buff2workspace: bidict[VirtualBuffer, VirtualWorkspace] = bidict()
         self._workspace2window: dict[VirtualWorkspace, sublime.Window] = {}
+        track_instance(self)
 
     def all_workspaces(
         self, window: Optional[sublime.Window] = None
@@ -86,16 +123,19 @@ class VirtualClient:
             return
         logger.info("disconnecting from the current client")
         # for each workspace tell it to clean up after itself.
-        for vws in self.all_workspaces():
-            self.uninstall_workspace(vws)
-            self.codemp.leave_workspace(vws.id)
+        with project_batch(), session.paused():
+            for vws in self.all_workspaces():
+                self.uninstall_workspace(vws)
+                self.codemp.leave_workspace(vws.id)
 
         self._id2workspace.clear()
         self._id2buffer.clear()
         self._buff2workspace.clear()
         self._view2buff.clear()
         self._workspace2window.clear()
-    
+        self.executor.shutdown()
+        self.rtt.reset()
+
         if self.driver is not None:
             self.driver.stop()
             self.driver = None
@@ -106,6 +146,7 @@ class VirtualClient:
             logger.info("Disconnecting from previous client.")
             return self.disconnect()
 
+        codemp = load_codemp()
         if self.driver is None:
             self.driver = codemp.init()
             logger.debug("registering logger callback...")
@@ -120,11 +161,15 @@ class VirtualClient:
         config.password = password
 
         self.codemp = codemp.connect(config).wait()
+        # a soak run or a replay, not a session worth remembering.
+        self.stand_in = _backend is not None
+        self.host = host
+        self.user = user
         id = self.codemp.user_id()
         logger.debug(f"Connected to '{host}' as user {user} (id: {id})")
 
     def install_workspace(self, workspace: codemp.Workspace, window: sublime.Window):
-        vws = VirtualWorkspace(workspace, window)
+        vws = VirtualWorkspace(workspace, window, self.executor, self.rtt)
         self._workspace2window[vws] = window
         self._id2workspace[vws.id] = vws
 
@@ -146,6 +191,14 @@ class VirtualClient:
         del self._id2buffer[buffer.id]
         del self._view2buff[buffer.view]
 
+    def buffer_from_placeholder(self, filename: str):
+        # (workspace, buffer id) of the placeholder file, if it is one.
+        for vws in self.all_workspaces():
+            buffer_id = vws.buffer_from_placeholder(filename)
+            if buffer_id is not None:
+                return vws, buffer_id
+        return None
+
     def workspaces_in_server(self):
         return self.codemp.active_workspaces() if self.codemp else []
 
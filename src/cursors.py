@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import sublime
+import threading
+import logging
+import time
+
+from . import globals as g
+from .utils import get_setting, draw_cursor_region, cursor_region_key
+
+logger = logging.getLogger(__name__)
+
+# all the cursor tables that are currently alive, refreshed periodically
+# so that we can cull what scrolled out of sight and forget idle users.
+_TABLES: list[RemoteCursors] = []
+_TICKING = False
+
+
+def detail_for(count: int) -> int:
+    if count <= get_setting("cursor_annotations_max", 4):
+        return g.CURSOR_DETAIL_FULL
+    if count <= get_setting("cursor_regions_max", 16):
+        return g.CURSOR_DETAIL_REGION
+    return g.CURSOR_DETAIL_MARKER
+
+
+def shift_point(point: int, begin: int, end: int, length: int) -> int:
+    # where a point ends up once [begin, end) is replaced by `length` characters.
+    if point >= end:
+        return point + length - (end - begin)
+    if point > begin:
+        return begin + length
+    return point
+
+
+def _is_visible(region: sublime.Region, visible: sublime.Region) -> bool:
+    return region.end() >= visible.begin() and region.begin() <= visible.end()
+
+
+def _tick():
+    global _TICKING
+    if not _TABLES:
+        _TICKING = False
+        return
+
+    timeout = get_setting("cursor_idle_timeout", 300)
+    for table in list(_TABLES):
+        table.refresh(timeout)
+
+    sublime.set_timeout(_tick, get_setting("cursor_refresh_interval", 250))
+
+
+# A table of the remote cursors of a single view, which decides
+# how (and whether) each of them gets drawn.
+class RemoteCursors:
+    def __init__(self, view: sublime.View):
+        self.view = view
+        self._lock = threading.Lock()
+        # user -> [start point, end point, last seen]
+        self._cursors: dict[str, list] = {}
+        self._drawn: set[str] = set()
+        self._detail = g.CURSOR_DETAIL_FULL
+        self._visible = None
+        # while the view takes a burst of remote edits we draw the cheap way:
+        # no annotations and nothing on the minimap.
+        self._burst = False
+        self._redraw_scheduled = False
+
+        global _TICKING
+        _TABLES.append(self)
+        if not _TICKING:
+            _TICKING = True
+            sublime.set_timeout(_tick, 0)
+
+    def __len__(self) -> int:
+        return len(self._cursors)
+
+    def set_burst(self, burst: bool):
+        with self._lock:
+            if burst != self._burst:
+                self._burst = burst
+                self._render()
+
+    def update(self, user: str, start: tuple[int, int], end: tuple[int, int]):
+        a = self.view.text_point(start[0], start[1])
+        b = self.view.text_point(end[0], end[1])
+        with self._lock:
+            self._cursors[user] = [a, b, time.monotonic()]
+            if self._detail_for() != self._detail:
+                # crossing a threshold changes how everyone is drawn.
+                self._render()
+            else:
+                self._render_one(user, self.view.visible_region())
+
+    def shift(self, changes: list[tuple[int, int, int]]):
+        # (begin, end, inserted length) of consecutive changes to the text.
+        # cursors follow the text around until their user moves again, and
+        # the redraw for a whole stream of changes happens once.
+        with self._lock:
+            if not self._cursors:
+                return
+            for cursor in self._cursors.values():
+                for begin, end, length in changes:
+                    cursor[0] = shift_point(cursor[0], begin, end, length)
+                    cursor[1] = shift_point(cursor[1], begin, end, length)
+            if self._redraw_scheduled:
+                return
+            self._redraw_scheduled = True
+        sublime.set_timeout(self._redraw)
+
+    def _redraw(self):
+        with self._lock:
+            self._redraw_scheduled = False
+            self._render()
+
+    def remove(self, user: str):
+        with self._lock:
+            self._cursors.pop(user, None)
+            self._render()
+
+    def refresh(self, timeout: float = 0):
+        with self._lock:
+            pruned = False
+            if timeout > 0:
+                cutoff = time.monotonic() - timeout
+                for user in [u for u, c in self._cursors.items() if c[2] < cutoff]:
+                    logger.debug(f"dropping idle cursor of '{user}'")
+                    del self._cursors[user]
+                    pruned = True
+
+            if pruned or self.view.visible_region() != self._visible:
+                self._render()
+
+    def clear(self):
+        with self._lock:
+            for key in self._drawn:
+                self.view.erase_regions(key)
+            self._drawn.clear()
+            self._cursors.clear()
+        if self in _TABLES:
+            _TABLES.remove(self)
+
+    # the following expect the lock to be held.
+    def _detail_for(self) -> int:
+        detail = detail_for(len(self._cursors))
+        if self._burst:
+            return max(detail, g.CURSOR_DETAIL_REGION)
+        return detail
+
+    def _render_one(self, user: str, visible: sublime.Region):
+        a, b, _ = self._cursors[user]
+        key = cursor_region_key(user)
+        region = sublime.Region(a, b)
+        if _is_visible(region, visible):
+            draw_cursor_region(
+                self.view, region, user, self._detail, minimap=not self._burst
+            )
+            self._drawn.add(key)
+        elif key in self._drawn:
+            self.view.erase_regions(key)
+            self._drawn.discard(key)
+
+    def _render(self):
+        self._detail = self._detail_for()
+        self._visible = self.view.visible_region()
+
+        stale = self._drawn - {cursor_region_key(u) for u in self._cursors}
+        for key in stale:
+            self.view.erase_regions(key)
+        self._drawn -= stale
+
+        for user in self._cursors:
+            self._render_one(user, self._visible)
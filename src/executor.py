@@ -0,0 +1,283 @@
+from __future__ import annotations
+from typing import Callable, Hashable, Optional
+from collections import deque
+
+import threading
+import logging
+import time
+
+from . import globals as g
+from .utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+# lanes, in order of priority.
+LANE_EDITS = 0
+LANE_CURSORS = 1
+LANE_META = 2
+
+
+# The queue of a lane whose tasks belong to buffers (keyed by view id).
+# Each buffer has its own FIFO and runs one task at a time, in order, while
+# different buffers run side by side: a slow send or attach only holds up
+# its own buffer. The buffer of the active view is always served first,
+# the others take turns and share a token bucket of `rate` tasks per
+# second, so a buffer rewritten wholesale by someone else can neither
+# starve the one being typed in nor the other background ones.
+class FairQueue:
+    def __init__(self, rate: float = 0, burst: int = 1):
+        self.configure(rate, burst)
+        self._refilled = time.monotonic()
+        self._queues: dict[Hashable, deque] = {}
+        self._turns: deque = deque()
+        # keys with a task running right now.
+        self._busy: set = set()
+        # key -> [completed, total wait, max wait]
+        self.served: dict[Hashable, list] = {}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def configure(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+
+    def append(self, item, key: Hashable = None):
+        if key not in self._queues:
+            self._queues[key] = deque()
+            self._turns.append(key)
+        self._queues[key].append(item)
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(
+                self.tokens + (now - self._refilled) * self.rate, self.burst
+            )
+        self._refilled = now
+
+    def _active_ready(self) -> bool:
+        key = g.ACTIVE_CODEMP_VIEW
+        return key in self._queues and key not in self._busy
+
+    def ready_in(self) -> Optional[float]:
+        # 0 if a task can run now, how long until one can, or None if
+        # there is nothing that may run (empty, or every buffer is busy).
+        if all(key in self._busy for key in self._queues):
+            return None
+        if self._active_ready() or self.rate <= 0:
+            return 0
+        self._refill(time.monotonic())
+        return max((1 - self.tokens) / self.rate, 0)
+
+    def take(self):
+        # (key, item) of the next task, the key stays busy until `done`.
+        if self._active_ready():
+            key = g.ACTIVE_CODEMP_VIEW
+        else:
+            while self._turns[0] in self._busy:
+                self._turns.rotate(-1)
+            key = self._turns[0]
+            self._turns.rotate(-1)
+            if self.rate > 0:
+                self.tokens -= 1
+
+        queue = self._queues[key]
+        item = queue.popleft()
+        if not queue:
+            del self._queues[key]
+            self._turns.remove(key)
+
+        wait = time.monotonic() - item[0]
+        served = self.served.setdefault(key, [0, 0.0, 0.0])
+        served[0] += 1
+        served[1] += wait
+        served[2] = max(served[2], wait)
+        self._busy.add(key)
+        return key, item
+
+    def done(self, key: Hashable):
+        self._busy.discard(key)
+
+    def forget(self, key: Hashable):
+        self.served.pop(key, None)
+
+    def stats(self) -> dict:
+        total = sum(s[0] for s in self.served.values()) or 1
+        return {
+            key: {
+                "depth": len(self._queues.get(key, ())),
+                "completed": completed,
+                "share": completed / total,
+                "avg_wait_ms": 1000 * waited / completed if completed else 0.0,
+                "max_wait_ms": 1000 * max_wait,
+            }
+            for key, (completed, waited, max_wait) in self.served.items()
+        }
+
+
+class Lane:
+    def __init__(self, name: str, limit: int, fair: Optional[FairQueue] = None):
+        self.name = name
+        # how many tasks of this lane may run at the same time.
+        # a limit of 1 also keeps the tasks of the lane in order,
+        # fair lanes keep the tasks of each buffer in order anyway.
+        self.limit = limit
+        self.queue = fair if fair is not None else deque()
+        self.fair = fair
+        self.running = 0
+
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def ready_in(self) -> Optional[float]:
+        if self.running >= self.limit:
+            return None
+        if self.fair is not None:
+            return self.fair.ready_in()
+        return 0 if self.queue else None
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.queue),
+            "running": self.running,
+            "completed": self.completed,
+            "avg_wait_ms": 1000 * self.total_wait / self.completed
+            if self.completed
+            else 0.0,
+            "max_wait_ms": 1000 * self.max_wait,
+        }
+
+
+# A small pool of worker threads dedicated to codemp I/O, so that blocking
+# on a slow promise does not hold up sublime's own async thread.
+# Workers always pick from the highest priority lane with work to do, and
+# neither the edits nor the metadata lane can occupy every worker, so the
+# other lanes always have somewhere to run.
+class PriorityExecutor:
+    def __init__(self, workers: int = 3):
+        self.workers = max(workers, 2)
+        self._cv = threading.Condition()
+        self._lanes = self._make_lanes()
+        self._threads: list[threading.Thread] = []
+        self._generation = 0
+
+    def submit(self, lane: int, fn: Callable, *args):
+        self.submit_for(None, lane, fn, *args)
+
+    def submit_for(self, key: Hashable, lane: int, fn: Callable, *args):
+        # `key` says which buffer the task belongs to, for the lanes that
+        # share their time fairly between buffers.
+        with self._cv:
+            if not self._threads:
+                self._start()
+            target = self._lanes[lane]
+            if target.fair is not None:
+                target.fair.append((time.monotonic(), fn, args), key)
+            else:
+                target.queue.append((time.monotonic(), fn, args))
+            self._cv.notify()
+
+    def stats(self) -> dict[str, dict]:
+        with self._cv:
+            return {lane.name: lane.stats() for lane in self._lanes}
+
+    def buffer_stats(self) -> dict[Hashable, dict]:
+        with self._cv:
+            return self._lanes[LANE_EDITS].fair.stats()  # pyright: ignore
+
+    def forget(self, key: Hashable):
+        with self._cv:
+            self._lanes[LANE_EDITS].fair.forget(key)  # pyright: ignore
+
+    def shutdown(self, timeout: float = 0.5):
+        with self._cv:
+            if not self._threads:
+                return
+            logger.debug("shutting down the codemp executor.")
+            # bumping the generation makes the current workers quit as soon as
+            # they are done with whatever they are doing.
+            self._generation += 1
+            threads, self._threads = self._threads, []
+            # fresh lanes, so that a worker still stuck on an old task
+            # does not count against the limits of the next generation.
+            self._lanes = self._make_lanes()
+            self._cv.notify_all()
+
+        deadline = time.monotonic() + timeout
+        for t in threads:
+            if t is threading.current_thread():
+                continue
+            t.join(max(deadline - time.monotonic(), 0))
+            if t.is_alive():
+                logger.warning(f"executor thread '{t.name}' is still blocked.")
+
+    def _make_lanes(self) -> list[Lane]:
+        return [
+            Lane("edits", self.workers - 1, FairQueue()),
+            Lane("cursors", 1),
+            Lane("meta", self.workers - 1),
+        ]
+
+    # expects the condition lock to be held.
+    def _start(self):
+        # read here rather than when the lanes are made, which happens
+        # as early as the import of the plugin.
+        self._lanes[LANE_EDITS].fair.configure(  # pyright: ignore
+            get_setting("background_edit_rate", 0),
+            get_setting("background_edit_burst", 20),
+        )
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self._work,
+                args=(self._generation,),
+                name=f"codemp-worker-{i}",
+                daemon=True,
+            )
+            self._threads.append(t)
+            t.start()
+
+    def _next(self):
+        # the first lane that can run something, or how long to wait
+        # before one of them can (None meaning until something changes).
+        timeout = None
+        for lane in self._lanes:
+            ready_in = lane.ready_in()
+            if ready_in == 0:
+                return lane, None
+            if ready_in is not None:
+                timeout = ready_in if timeout is None else min(timeout, ready_in)
+        return None, timeout
+
+    def _work(self, generation: int):
+        while True:
+            with self._cv:
+                while generation == self._generation:
+                    lane, timeout = self._next()
+                    if lane is not None:
+                        break
+                    self._cv.wait(timeout)
+                if generation != self._generation:
+                    return
+
+                if lane.fair is not None:
+                    key, (queued_at, fn, args) = lane.fair.take()
+                else:
+                    key, (queued_at, fn, args) = None, lane.queue.popleft()
+                lane.running += 1
+                wait = time.monotonic() - queued_at
+                lane.total_wait += wait
+                lane.max_wait = max(lane.max_wait, wait)
+
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception(f"task on the {lane.name} lane failed: {e}")
+            finally:
+                with self._cv:
+                    if lane.fair is not None:
+                        lane.fair.done(key)
+                    lane.running -= 1
+                    lane.completed += 1
+                    self._cv.notify_all()
@@ -0,0 +1,533 @@
+from __future__ import annotations
+from typing import Callable, Optional
+
+import threading
+import logging
+import random
+import heapq
+import time
+
+logger = logging.getLogger(__name__)
+
+# An in-process stand-in for the codemp bindings, with a simulated server and
+# network. It implements the part of the api the plugin uses, so that the real
+# client code can be driven without a server. Every request and every event
+# travels through `Network`, which delays it by half a (jittered) round-trip
+# and, on loss, by a retransmission timeout on top. Like the streams of the
+# real client, each link delivers in order: nothing overtakes what was sent
+# before it on the same link, a retransmission holds up what follows.
+
+
+class Network:
+    def __init__(self, rtt_ms: float = 50, jitter_ms: float = 10, loss: float = 0.0):
+        self.rtt = rtt_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.loss = loss
+        self._cv = threading.Condition()
+        self._queue: list = []
+        self._seq = 0
+        # link -> when the last delivery on it arrives.
+        self._last: dict = {}
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="codemp-fake-network", daemon=True
+        )
+        self._thread.start()
+
+    def one_way(self) -> float:
+        delay = max(self.rtt / 2 + random.uniform(-self.jitter, self.jitter), 0)
+        # a lost packet is retransmitted after a timeout, possibly more than once.
+        while random.random() < self.loss:
+            delay += max(self.rtt * 2, 0.2)
+        return delay
+
+    def deliver(self, fn: Callable, *args, link=None):
+        with self._cv:
+            self._seq += 1
+            at = time.monotonic() + self.one_way()
+            if link is not None:
+                at = max(at, self._last.get(link, 0))
+                self._last[link] = at
+            heapq.heappush(self._queue, (at, self._seq, fn, args))
+            self._cv.notify()
+
+    def depth(self) -> int:
+        with self._cv:
+            return len(self._queue)
+
+    def stop(self):
+        with self._cv:
+            self._running = False
+            self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while self._running and (
+                    not self._queue or self._queue[0][0] > time.monotonic()
+                ):
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cv.wait(timeout)
+                if not self._running:
+                    return
+                _, _, fn, args = heapq.heappop(self._queue)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception(f"fake network delivery failed: {e}")
+
+
+class Promise:
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error: Optional[Exception] = None
+
+    def _resolve(self, value=None, error: Optional[Exception] = None):
+        self._value = value
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+
+def _request(net: Network, fn: Callable, link=None) -> Promise:
+    # the request travels to the server, the answer travels back, each on
+    # the link of whoever made the request (up and down respectively).
+    promise = Promise()
+    up, down = (None, None) if link is None else (("up", link), ("down", link))
+
+    def at_server():
+        try:
+            value = fn()
+        except Exception as e:
+            net.deliver(promise._resolve, None, e, link=down)
+        else:
+            net.deliver(promise._resolve, value, link=down)
+
+    net.deliver(at_server, link=up)
+    return promise
+
+
+class TextChange:
+    def __init__(self, start: int, end: int, content: str):
+        self.start = start
+        self.end = end
+        self.content = content
+        self.sent_at = time.monotonic()
+
+    def is_empty(self) -> bool:
+        return self.start == self.end and not self.content
+
+
+class Cursor:
+    def __init__(self, buffer: str, user: str, start, end):
+        self.buffer = buffer
+        self.user = user
+        self.start = start
+        self.end = end
+        self.sent_at = time.monotonic()
+
+
+class User:
+    def __init__(self, name: str):
+        self.name = name
+
+
+# the variants of the workspace event enum, named the way the bindings name them.
+class _Event:
+    def __init__(self, value: str):
+        self._0 = value
+
+
+class Event_FileTreeUpdated(_Event):
+    pass
+
+
+class Event_UserJoin(_Event):
+    pass
+
+
+class Event_UserLeave(_Event):
+    pass
+
+
+class Config:
+    def __init__(self):
+        self.username = ""
+        self.host = ""
+        self.password = ""
+
+
+class Driver:
+    def stop(self):
+        pass
+
+
+class Server:
+    def __init__(self, network: Network):
+        self.network = network
+        self.lock = threading.RLock()
+        self.workspaces: dict[str, ServerWorkspace] = {}
+        # how long events took from their origin to being pulled by the plugin.
+        self.latencies: list[float] = []
+
+    def workspace(self, id: str) -> ServerWorkspace:
+        with self.lock:
+            if id not in self.workspaces:
+                self.workspaces[id] = ServerWorkspace(self, id)
+            return self.workspaces[id]
+
+    def take_latencies(self) -> list[float]:
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def record_latency(self, item):
+        sent_at = getattr(item, "sent_at", None)
+        if sent_at is not None:
+            with self.lock:
+                self.latencies.append(time.monotonic() - sent_at)
+
+
+class ServerWorkspace:
+    def __init__(self, server: Server, id: str):
+        self.server = server
+        self.id = id
+        self.buffers: dict[str, str] = {}
+        self.users: set[str] = set()
+        self.buffer_ctls: dict[str, list[BufferController]] = {}
+        self.cursor_ctls: list[CursorController] = []
+        self.handles: list[Workspace] = []
+
+    def apply(self, path: str, change: TextChange, origin=None):
+        with self.server.lock:
+            text = self.buffers.get(path, "")
+            start = min(change.start, len(text))
+            end = min(max(change.end, start), len(text))
+            self.buffers[path] = text[:start] + change.content + text[end:]
+            targets = [c for c in self.buffer_ctls.get(path, []) if c is not origin]
+        for ctl in targets:
+            self.server.network.deliver(ctl._push, change, link=("down", ctl))
+
+    def move_cursor(self, event: Cursor, origin=None):
+        with self.server.lock:
+            targets = [c for c in self.cursor_ctls if c is not origin]
+        for ctl in targets:
+            self.server.network.deliver(ctl._push, event, link=("down", ctl))
+
+    def broadcast(self, event: _Event, origin=None):
+        with self.server.lock:
+            targets = [h for h in self.handles if h is not origin]
+        for handle in targets:
+            self.server.network.deliver(handle._push, event, link=("down", handle))
+
+
+class _Controller:
+    def __init__(self, server: Server):
+        self._server = server
+        self._lock = threading.Lock()
+        self._queue: list = []
+        self._cb = None
+        self._stopped = False
+
+    def _push(self, item):
+        with self._lock:
+            if self._stopped:
+                return
+            self._queue.append(item)
+            cb = self._cb
+        if cb is not None:
+            cb(self)
+
+    def try_recv(self) -> Promise:
+        with self._lock:
+            item = self._queue.pop(0) if self._queue else None
+        if item is not None:
+            self._server.record_latency(item)
+        promise = Promise()
+        promise._resolve(item)
+        return promise
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def callback(self, cb):
+        self._cb = cb
+
+    def clear_callback(self):
+        self._cb = None
+
+    def stop(self) -> bool:
+        with self._lock:
+            self._stopped = True
+            self._queue.clear()
+        return True
+
+
+class BufferController(_Controller):
+    def __init__(self, ws: ServerWorkspace, path: str):
+        super().__init__(ws.server)
+        self._ws = ws
+        self._path = path
+
+    def path(self) -> str:
+        return self._path
+
+    def content(self) -> Promise:
+        return _request(
+            self._server.network, lambda: self._ws.buffers.get(self._path, ""), self
+        )
+
+    def send(self, start: int, end: int, content: str) -> Promise:
+        change = TextChange(start, end, content)
+        return _request(
+            self._server.network, lambda: self._ws.apply(self._path, change, self), self
+        )
+
+
+class CursorController(_Controller):
+    def __init__(self, ws: ServerWorkspace, user: str):
+        super().__init__(ws.server)
+        self._ws = ws
+        self._user = user
+
+    def send(self, buffer: str, start, end) -> Promise:
+        event = Cursor(buffer, self._user, start, end)
+        return _request(
+            self._server.network, lambda: self._ws.move_cursor(event, self), self
+        )
+
+
+class Workspace(_Controller):
+    def __init__(self, ws: ServerWorkspace, user: str):
+        super().__init__(ws.server)
+        self._ws = ws
+        self._user = user
+        self._net = ws.server.network
+        self._cursor = CursorController(ws, user)
+        self._attached: dict[str, BufferController] = {}
+        with ws.server.lock:
+            ws.cursor_ctls.append(self._cursor)
+            ws.users.add(user)
+            ws.handles.append(self)
+        ws.broadcast(Event_UserJoin(user), self)
+
+    def id(self) -> str:
+        return self._ws.id
+
+    def cursor(self) -> CursorController:
+        return self._cursor
+
+    def fetch_buffers(self) -> Promise:
+        return _request(self._net, lambda: None, self)
+
+    def fetch_users(self) -> Promise:
+        return _request(self._net, lambda: None, self)
+
+    def user_list(self) -> list[User]:
+        with self._ws.server.lock:
+            return [User(name) for name in self._ws.users]
+
+    def filetree(self, filter: Optional[str] = None, strict: bool = False) -> list[str]:
+        with self._ws.server.lock:
+            paths = list(self._ws.buffers)
+        if filter is None:
+            return paths
+        return [p for p in paths if (p == filter if strict else p.startswith(filter))]
+
+    def buffer_list(self) -> list[str]:
+        return list(self._attached)
+
+    def create(self, path: str) -> Promise:
+        def create():
+            with self._ws.server.lock:
+                if path in self._ws.buffers:
+                    raise ValueError(f"buffer '{path}' already exists")
+                self._ws.buffers[path] = ""
+            self._ws.broadcast(Event_FileTreeUpdated(path))
+
+        return _request(self._net, create, self)
+
+    def delete(self, path: str) -> Promise:
+        def delete():
+            with self._ws.server.lock:
+                self._ws.buffers.pop(path, None)
+            self._ws.broadcast(Event_FileTreeUpdated(path))
+
+        return _request(self._net, delete, self)
+
+    def attach(self, path: str) -> Promise:
+        def attach():
+            with self._ws.server.lock:
+                if path not in self._ws.buffers:
+                    raise ValueError(f"no buffer '{path}'")
+                ctl = BufferController(self._ws, path)
+                self._ws.buffer_ctls.setdefault(path, []).append(ctl)
+            self._attached[path] = ctl
+            return ctl
+
+        return _request(self._net, attach, self)
+
+    def detach(self, path: str) -> bool:
+        ctl = self._attached.pop(path, None)
+        if ctl is None:
+            return False
+        with self._ws.server.lock:
+            ctls = self._ws.buffer_ctls.get(path, [])
+            if ctl in ctls:
+                ctls.remove(ctl)
+        ctl.stop()
+        return True
+
+    def _leave(self):
+        for path in list(self._attached):
+            self.detach(path)
+        with self._ws.server.lock:
+            if self._cursor in self._ws.cursor_ctls:
+                self._ws.cursor_ctls.remove(self._cursor)
+            if self in self._ws.handles:
+                self._ws.handles.remove(self)
+            self._ws.users.discard(self._user)
+        self._ws.broadcast(Event_UserLeave(self._user), self)
+        self._cursor.stop()
+        self.stop()
+
+
+class Client:
+    def __init__(self, server: Server, user: str):
+        self._server = server
+        self._user = user
+        self._joined: dict[str, Workspace] = {}
+
+    def user_id(self) -> str:
+        return self._user
+
+    def join_workspace(self, id: str) -> Promise:
+        def join():
+            ws = Workspace(self._server.workspace(id), self._user)
+            self._joined[id] = ws
+            return ws
+
+        return _request(self._server.network, join, self)
+
+    def leave_workspace(self, id: str) -> bool:
+        ws = self._joined.pop(id, None)
+        if ws is None:
+            return False
+        ws._leave()
+        return True
+
+    def active_workspaces(self) -> list[str]:
+        return list(self._joined)
+
+    def list_workspaces(self, owned: bool = True, invited: bool = True) -> Promise:
+        return _request(
+            self._server.network, lambda: list(self._server.workspaces), self
+        )
+
+    def create_workspace(self, id: str) -> Promise:
+        def create():
+            self._server.workspace(id)
+
+        return _request(self._server.network, create, self)
+
+    def delete_workspace(self, id: str) -> Promise:
+        def delete():
+            with self._server.lock:
+                self._server.workspaces.pop(id, None)
+
+        return _request(self._server.network, delete, self)
+
+    def invite_to_workspace(self, workspace: str, user: str) -> Promise:
+        return _request(self._server.network, lambda: None, self)
+
+
+# A peer editing alongside the plugin: it joins a workspace on the fake
+# server, attaches to its buffers and types and moves around at random.
+class Peer:
+    ALPHABET = "abcdefghijklmnopqrstuvwxyz     \n"
+
+    def __init__(
+        self,
+        server: Server,
+        workspace: str,
+        name: str,
+        edit_rate: float = 5.0,
+        cursor_rate: float = 5.0,
+    ):
+        self.name = name
+        self.edit_rate = edit_rate
+        self.cursor_rate = cursor_rate
+        self.edits = 0
+        self.client = Client(server, name)
+        self.workspace: Workspace = self.client.join_workspace(workspace).wait()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"codemp-fake-peer-{name}", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.client.leave_workspace(self.workspace.id())
+
+    def _run(self):
+        rate = self.edit_rate + self.cursor_rate
+        while not self._stop.wait(random.expovariate(rate) if rate > 0 else 1):
+            paths = self.workspace.filetree()
+            if not paths:
+                continue
+            path = random.choice(paths)
+            if path not in self.workspace._attached:
+                try:
+                    self.workspace.attach(path).wait()
+                except ValueError:
+                    continue
+            ctl = self.workspace._attached[path]
+            text = self.workspace._ws.buffers.get(path, "")
+
+            at = random.randint(0, len(text))
+            if random.random() < self.edit_rate / rate:
+                if text and random.random() < 0.3:
+                    ctl.send(at, min(at + random.randint(1, 8), len(text)), "")
+                else:
+                    word = random.choices(self.ALPHABET, k=random.randint(1, 8))
+                    ctl.send(at, at, "".join(word))
+                self.edits += 1
+            else:
+                row = text.count("\n", 0, at)
+                col = at - (text.rfind("\n", 0, at) + 1)
+                self.workspace.cursor().send(path, (row, col), (row, col))
+
+
+# module level api, mirroring the real bindings. `SERVER` must be set
+# before connecting.
+SERVER: Optional[Server] = None
+
+
+def init() -> Driver:
+    return Driver()
+
+
+def set_logger(cb, debug: bool) -> bool:
+    return True
+
+
+def get_default_config() -> Config:
+    return Config()
+
+
+def connect(config: Config) -> Promise:
+    assert SERVER is not None, "no fake codemp server to connect to"
+    return _request(SERVER.network, lambda: Client(SERVER, config.username))
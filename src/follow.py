@@ -0,0 +1,124 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional
+
+import sublime
+import threading
+import logging
+
+from .executor import LANE_META
+from .utils import get_setting
+
+if TYPE_CHECKING:
+    from .client import VirtualClient
+    from .workspace import VirtualWorkspace
+    from .buffers import VirtualBuffer
+
+logger = logging.getLogger(__name__)
+
+
+# Follows the cursor of one user around a workspace: the view of whatever
+# buffer they are in is brought to the front and kept on their cursor.
+# The buffers they visit most are attached ahead of time in the background,
+# so that following them there does not wait on an attach and a full sync.
+class Follower:
+    def __init__(
+        self,
+        client: VirtualClient,
+        vws: VirtualWorkspace,
+        window: sublime.Window,
+        user: str,
+    ):
+        self.client = client
+        self.vws = vws
+        self.window = window
+        self.user = user
+        self.prefetch_count = get_setting("follow_prefetch", 3)
+
+        self._lock = threading.Lock()
+        self._current: Optional[str] = None
+        self._position: Optional[tuple] = None
+        self._attaching: set[str] = set()
+        self._events = 0
+
+    def start(self):
+        if self.vws.follower is not None:
+            self.vws.follower.stop()
+        self.vws.follower = self
+        sublime.status_message(f"[codemp] following {self.user}")
+        self.client.executor.submit(LANE_META, self.prefetch)
+
+    def stop(self):
+        if self.vws.follower is self:
+            self.vws.follower = None
+            sublime.status_message(f"[codemp] stopped following {self.user}")
+
+    def on_cursor(self, event):
+        # called on the cursor lane for every cursor event of the workspace.
+        if event.user != self.user:
+            return
+        with self._lock:
+            moved = event.buffer != self._current
+            self._current = event.buffer
+            self._position = event.start
+            self._events += 1
+            prefetch = self._events % 50 == 0
+
+        vbuff = self.vws.buff_by_id(event.buffer)
+        if vbuff is not None:
+            sublime.set_timeout(lambda: self._show(vbuff, moved))
+        elif moved:
+            self._attach(event.buffer, lambda vbuff: self._show(vbuff, True))
+
+        # where they spend their time changes, so every so often
+        # we look again at what is worth having at hand.
+        if prefetch:
+            self.client.executor.submit(LANE_META, self.prefetch)
+
+    def _show(self, vbuff: VirtualBuffer, focus: bool):
+        with self._lock:
+            if vbuff.id != self._current or self._position is None:
+                return  # they moved on in the meantime.
+            row, col = self._position
+        if focus:
+            self.window.focus_view(vbuff.view)
+        vbuff.view.show(vbuff.view.text_point(row, col))
+
+    def prefetch(self):
+        touches = dict(self.vws.touches.get(self.user, {}))
+        favourites = sorted(touches, key=lambda path: -touches[path])
+        for path in favourites[: self.prefetch_count]:
+            if self.vws.buff_by_id(path) is None:
+                logger.debug(f"prefetching '{path}', a favourite of {self.user}")
+                self._attach(path, background=True)
+
+    def _attach(
+        self,
+        path: str,
+        then: Optional[Callable[[VirtualBuffer], None]] = None,
+        background: bool = False,
+    ):
+        with self._lock:
+            if path in self._attaching:
+                return
+            self._attaching.add(path)
+        promise = self.vws.codemp.attach(path)
+
+        def _():
+            try:
+                buffctl = promise.wait()
+            except Exception as e:
+                logger.warning(f"could not attach to '{path}' to follow {self.user}: {e}")
+                with self._lock:
+                    self._attaching.discard(path)
+                return
+
+            # a new view takes the focus, give it back if we are only prefetching.
+            active = self.window.active_view()
+            vbuff = self.vws.install_buffer(buffctl, then)
+            self.client.register_buffer(self.vws, vbuff)
+            with self._lock:
+                self._attaching.discard(path)
+            if background and active is not None:
+                sublime.set_timeout(lambda: self.window.focus_view(active))
+
+        self.client.executor.submit(LANE_META, _)
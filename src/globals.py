@@ -1,3 +1,9 @@
+import time
+
+# when the package started loading, and how long the expensive bits took.
+LOAD_STARTED = time.perf_counter()
+LOAD_TIMES: dict = {}
+
 BUFFCTL_TASK_PREFIX = "buffer-ctl"
 CURCTL_TASK_PREFIX = "cursor-ctl"
 
@@ -11,8 +17,14 @@ CODEMP_WINDOW_WORKSPACES = "codemp-workspaces"
 WORKSPACE_FOLDER_PREFIX = "CODEMP::"
 SUBLIME_REGIONS_PREFIX = "codemp-cursors"
 SUBLIME_STATUS_ID = "z_codemp_buffer"
-CODEMP_IGNORE_NEXT_TEXT_CHANGE = "codemp-skip-change-event"
+SETTINGS_FILE = "CodempClient.sublime-settings"
+
+# level of detail used to draw remote cursors, from richest to cheapest.
+CURSOR_DETAIL_FULL = 0
+CURSOR_DETAIL_REGION = 1
+CURSOR_DETAIL_MARKER = 2
 
+# the id of the codemp view that has the focus, if any.
 ACTIVE_CODEMP_VIEW = None
 ACTIVE_CODEMP_WINDOW = None
 
@@ -0,0 +1,62 @@
+from __future__ import annotations
+from typing import Optional
+
+import threading
+
+from .utils import get_setting
+
+
+def _clamp(value: float, bounds) -> float:
+    lo, hi = bounds
+    return min(max(value, lo), hi)
+
+
+# Smoothed round-trip time to the server, estimated from how long send
+# promises take to complete (the same smoothing TCP uses, RFC 6298).
+# The batching windows for edits and cursors follow it, within the bounds
+# given in the settings.
+class RttEstimator:
+    def __init__(self, initial: float = 0.05):
+        self.initial = initial
+        self._lock = threading.Lock()
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.samples = 0
+
+    def reset(self):
+        with self._lock:
+            self.srtt = None
+            self.rttvar = 0.0
+            self.samples = 0
+
+    def observe(self, sample: float):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = sample
+                self.rttvar = sample / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+                self.srtt = 0.875 * self.srtt + 0.125 * sample
+            self.samples += 1
+
+    def rtt(self) -> float:
+        return self.initial if self.srtt is None else self.srtt
+
+    def edit_window(self) -> float:
+        # on a fast link we send right away, on a slow one we give the user a
+        # fraction of a round-trip to keep typing before sending it all at once.
+        bounds = get_setting("edit_window_ms", [0, 100])
+        return _clamp(self.rtt() * 1000 / 4, bounds) / 1000
+
+    def cursor_interval(self) -> float:
+        bounds = get_setting("cursor_interval_ms", [16, 250])
+        return _clamp(self.rtt() * 1000 / 2, bounds) / 1000
+
+    def status(self) -> str:
+        if self.srtt is None:
+            return "[Codemp]"
+        return (
+            f"[Codemp] rtt {self.srtt * 1000:.0f}ms"
+            f" · edits {self.edit_window() * 1000:.0f}ms"
+            f" · cursor {self.cursor_interval() * 1000:.0f}ms"
+        )
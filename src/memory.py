@@ -0,0 +1,205 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional
+from collections import deque
+
+import tracemalloc
+import threading
+import logging
+import sys
+import gc
+import os
+
+from .profiler import PACKAGE_ROOT
+from .utils import live_instances
+from .executor import PriorityExecutor
+from .search import TrigramIndex
+from .latency import RttEstimator
+
+if TYPE_CHECKING:
+    from .client import VirtualClient
+
+logger = logging.getLogger(__name__)
+
+# what an estimate follows into, anything else (views, controllers, other
+# bridge objects) lives outside python or is counted on its own.
+_CONTAINERS = (dict, list, tuple, set, frozenset, deque)
+_LEAVES = (str, bytes, int, float, bool, type(None))
+# held by many buffers and workspaces at once, reported once each.
+_SHARED = (PriorityExecutor, TrigramIndex, RttEstimator)
+
+
+def _deep_size(root, skip: set[int], max_depth: Optional[int]) -> int:
+    seen: set[int] = set()
+
+    def size(o, depth: int) -> int:
+        if id(o) in seen or id(o) in skip:
+            return 0
+        if max_depth is not None and depth > max_depth:
+            return 0
+        if depth > 0 and isinstance(o, _SHARED):
+            return 0
+        seen.add(id(o))
+        total = sys.getsizeof(o, 0)
+        if isinstance(o, _LEAVES):
+            return total
+        if isinstance(o, dict):
+            for k, v in list(o.items()):
+                total += size(k, depth + 1) + size(v, depth + 1)
+        elif isinstance(o, _CONTAINERS):
+            for item in list(o):
+                total += size(item, depth + 1)
+        elif _is_own(o) or depth == 0 and hasattr(o, "__dict__"):
+            total += size(vars(o), depth + 1)
+        return total
+
+    return size(root, 0)
+
+
+def footprint(obj, max_depth: int = 4) -> int:
+    # a rough estimate of the memory an object holds on its own: itself,
+    # its attributes and the containers and text they reference.
+    tracked = {id(o) for objs in live_instances().values() for o in objs}
+    tracked.discard(id(obj))
+    return _deep_size(obj, tracked, max_depth)
+
+
+def index_footprint(index: TrigramIndex) -> int:
+    # the texts and trigram sets of the index, however deep they sit.
+    with index._lock:
+        return _deep_size(index, set(), None)
+
+
+def _is_own(o) -> bool:
+    # plain helper objects of the plugin (ledgers, cursor tables, lanes)
+    # count towards whoever holds them.
+    module = getattr(type(o), "__module__", "") or ""
+    return hasattr(o, "__dict__") and module.startswith(__package__ or "src")
+
+
+def _module_of(filename: str) -> str:
+    relative = os.path.relpath(filename, PACKAGE_ROOT)
+    return os.path.splitext(relative)[0].replace(os.sep, ".")
+
+
+# tracemalloc snapshots of the plugin's own allocations, each report is
+# compared with the one before so that growth shows up per module.
+class MemoryTracker:
+    def __init__(self, frames: int = 5):
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        self.started_tracing = False
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        with self._lock:
+            self._previous = self._snapshot()
+
+    def stop(self):
+        with self._lock:
+            self._previous = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, os.path.join(PACKAGE_ROOT, "*"))]
+        )
+
+    def diff(self, top: int = 10):
+        # (per module, per line) growth since the previous call.
+        current = self._snapshot()
+        with self._lock:
+            previous, self._previous = self._previous, current
+        if previous is None:
+            return [], []
+
+        modules: dict[str, list[int]] = {}
+        for stat in current.compare_to(previous, "filename"):
+            frame = stat.traceback[0]
+            entry = modules.setdefault(_module_of(frame.filename), [0, 0, 0])
+            entry[0] += stat.size
+            entry[1] += stat.size_diff
+            entry[2] += stat.count_diff
+        lines = [
+            stat
+            for stat in current.compare_to(previous, "lineno")
+            if stat.size_diff
+        ][:top]
+        return sorted(modules.items(), key=lambda m: -abs(m[1][1])), lines
+
+
+TRACKER = MemoryTracker()
+
+
+def report(client: VirtualClient, dispatch_depth: int = 0) -> str:
+    gc.collect()
+    lines = ["live objects:"]
+    for name, objs in sorted(live_instances().items()):
+        total = sum(footprint(o) for o in objs)
+        lines.append(f"  {name:<18} {len(objs):>5}  ~{total / 1024:.1f}kB")
+
+    shared: dict[int, tuple[str, object]] = {
+        id(client.executor): ("executor", client.executor)
+    }
+    for vws in client.all_workspaces():
+        shared.setdefault(id(vws.rtt), ("rtt estimator", vws.rtt))
+        shared[id(vws.search_index)] = (f"index of {vws.id}", vws.search_index)
+    lines += ["", "shared:"]
+    for name, obj in shared.values():
+        if isinstance(obj, TrigramIndex):
+            size, detail = index_footprint(obj), f"{len(obj)} documents"
+        else:
+            size, detail = footprint(obj), ""
+        lines.append(f"  {name[-24:]:<24} ~{size / 1024:.1f}kB  {detail}".rstrip())
+
+    queues = client.executor.buffer_stats()
+    buffers = client.all_buffers()
+    if buffers:
+        lines += [
+            "",
+            f"{'buffer':<32} {'size':>9} {'outbox':>7} {'shadow':>7} "
+            f"{'ledger':>7} {'lane':>5} {'cursors':>8}",
+        ]
+    for vbuff in sorted(buffers, key=lambda b: b.id):
+        lane = queues.get(vbuff.view.id(), {}).get("depth", 0)
+        lines.append(
+            f"{vbuff.id[-32:]:<32} {footprint(vbuff) / 1024:>7.1f}kB "
+            f"{len(vbuff._outbox):>7} {len(vbuff._shadow_changes):>7} "
+            f"{len(vbuff.ledger):>7} {lane:>5} {len(vbuff.cursors):>8}"
+        )
+    lines += ["", f"local changes waiting for dispatch: {dispatch_depth}"]
+
+    if not TRACKER.tracing:
+        lines += ["", "tracemalloc is off: run the report again to see allocations."]
+        TRACKER.start()
+        return "\n".join(lines) + "\n"
+
+    modules, top = TRACKER.diff()
+    current, peak = tracemalloc.get_traced_memory()
+    lines += [
+        "",
+        f"traced: {current / 1024:.0f}kB (peak {peak / 1024:.0f}kB), "
+        "allocations of the plugin since the last report:",
+        f"  {'module':<28} {'size':>10} {'growth':>10} {'blocks':>8}",
+    ]
+    for name, (size, growth, blocks) in modules:
+        lines.append(
+            f"  {name:<28} {size / 1024:>8.1f}kB {growth / 1024:>+8.1f}kB {blocks:>+8}"
+        )
+    if top:
+        lines += ["", "top lines:"]
+        for stat in top:
+            frame = stat.traceback[0]
+            lines.append(
+                f"  {stat.size_diff / 1024:>+8.1f}kB {stat.count_diff:>+6}  "
+                f"{_module_of(frame.filename)}:{frame.lineno}"
+            )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,126 @@
+from __future__ import annotations
+from typing import Optional
+
+import threading
+import logging
+import types
+import time
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _qualnames() -> dict[types.CodeType, str]:
+    # map the code objects of the plugin to readable names, including the
+    # closures, e.g. `buffers.make_bufferchange_cb.__callback._`.
+    names: dict[types.CodeType, str] = {}
+
+    def walk(code: types.CodeType, name: str):
+        names[code] = name
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                walk(const, f"{name}.{const.co_name}")
+
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None) or ""
+        path = os.path.abspath(path)
+        if not path.startswith(PACKAGE_ROOT + os.sep):
+            continue
+        prefix = os.path.splitext(os.path.relpath(path, PACKAGE_ROOT))[0]
+        prefix = prefix.replace(os.sep, ".")
+        for obj in list(vars(module).values()):
+            members = vars(obj).values() if isinstance(obj, type) else [obj]
+            for member in members:
+                func = getattr(member, "__func__", member)
+                code = getattr(func, "__code__", None)
+                if (
+                    isinstance(code, types.CodeType)
+                    and os.path.abspath(code.co_filename) == path
+                ):
+                    walk(code, f"{prefix}.{func.__qualname__}")
+    return names
+
+
+# A sampling profiler for the threads running plugin code. Every `interval`
+# seconds it looks at the stack of every thread and counts the ones that go
+# through the plugin, attributing them to the thread they were seen on.
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks: dict[str, int] = {}
+        self._names: dict[types.CodeType, str] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+        self.elapsed = 0.0
+
+    def start(self):
+        self._names = _qualnames()
+        self._started = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="codemp-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.monotonic() - self._started
+
+    def _label(self, code: types.CodeType) -> Optional[str]:
+        name = self._names.get(code)
+        if name is not None:
+            return name
+        if code.co_filename.startswith(PACKAGE_ROOT + os.sep):
+            return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        return None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            threads = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    label = self._label(frame.f_code)
+                    if label is not None:
+                        stack.append(label)
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.append(threads.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def write_collapsed(self, path: str):
+        # the format understood by flamegraph.pl, speedscope and friends.
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+    def summary(self, top: int = 25) -> str:
+        own: dict[str, int] = {}
+        total: dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+
+        lines = [
+            f"{self.samples} samples over {self.elapsed:.1f}s "
+            f"every {self.interval * 1000:.1f}ms",
+            "",
+            f"{'self':>6} {'total':>6}  function",
+        ]
+        for name, count in sorted(total.items(), key=lambda i: -i[1])[:top]:
+            lines.append(f"{own.get(name, 0):>6} {count:>6}  {name}")
+        return "\n".join(lines) + "\n"
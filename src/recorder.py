@@ -0,0 +1,324 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+from collections import deque
+
+import sublime
+import threading
+import logging
+import struct
+import time
+
+if TYPE_CHECKING:
+    from .client import VirtualClient
+    from .workspace import VirtualWorkspace
+    from .buffers import VirtualBuffer
+
+logger = logging.getLogger(__name__)
+
+# Recordings are an append-only sequence of records after a short header.
+# Each record is a timestamp (seconds since the recording started) and a kind,
+# followed by the fields of that kind. Strings are length prefixed utf-8.
+MAGIC = b"CMPR\x01"
+KIND_REMOTE_CHANGE = 1
+KIND_CURSOR = 2
+KIND_LOCAL_CHANGE = 3
+
+_HEAD = struct.Struct("<dB")
+_U32 = struct.Struct("<I")
+_RANGE = struct.Struct("<II")
+_ROWCOLS = struct.Struct("<IIII")
+
+# the active recorder, if any. checked on the hot paths, so keep it a plain global.
+RECORDER: Optional[Recorder] = None
+
+
+def _pack_str(s: str) -> bytes:
+    data = s.encode()
+    return _U32.pack(len(data)) + data
+
+
+def _unpack_str(data: bytes, at: int) -> Tuple[str, int]:
+    (size,) = _U32.unpack_from(data, at)
+    at += _U32.size
+    return data[at : at + size].decode(), at + size
+
+
+class Recorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def _write(self, kind: int, payload: bytes):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(_HEAD.pack(time.monotonic() - self._start, kind))
+            self._file.write(payload)
+            self.records += 1
+
+    def remote_change(self, buffer: str, start: int, end: int, content: str):
+        self._write(
+            KIND_REMOTE_CHANGE,
+            _pack_str(buffer) + _RANGE.pack(start, end) + _pack_str(content),
+        )
+
+    def local_change(self, buffer: str, start: int, end: int, content: str):
+        self._write(
+            KIND_LOCAL_CHANGE,
+            _pack_str(buffer) + _RANGE.pack(start, end) + _pack_str(content),
+        )
+
+    def cursor(self, buffer: str, user: str, start, end):
+        self._write(
+            KIND_CURSOR,
+            _pack_str(buffer)
+            + _pack_str(user)
+            + _ROWCOLS.pack(start[0], start[1], end[0], end[1]),
+        )
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def start_recording(path: str) -> Recorder:
+    global RECORDER
+    stop_recording()
+    RECORDER = Recorder(path)
+    logger.info(f"recording codemp events to '{path}'")
+    return RECORDER
+
+
+def stop_recording() -> Optional[Recorder]:
+    global RECORDER
+    rec, RECORDER = RECORDER, None
+    if rec is not None:
+        rec.close()
+        logger.info(f"stopped recording, {rec.records} events in '{rec.path}'")
+    return rec
+
+
+def read_records(path: str) -> Iterator[Tuple[float, int, tuple]]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"'{path}' is not a codemp recording")
+
+    at = len(MAGIC)
+    while at < len(data):
+        ts, kind = _HEAD.unpack_from(data, at)
+        at += _HEAD.size
+        buffer, at = _unpack_str(data, at)
+        if kind == KIND_CURSOR:
+            user, at = _unpack_str(data, at)
+            sr, sc, er, ec = _ROWCOLS.unpack_from(data, at)
+            at += _ROWCOLS.size
+            yield ts, kind, (buffer, user, (sr, sc), (er, ec))
+        else:
+            start, end = _RANGE.unpack_from(data, at)
+            at += _RANGE.size
+            content, at = _unpack_str(data, at)
+            yield ts, kind, (buffer, start, end, content)
+
+
+# Stub controllers, mimicking the parts of the codemp api the plugin uses,
+# so that a recording can be fed through the real pipeline offline.
+class StubPromise:
+    def __init__(self, value=None):
+        self.value = value
+
+    def wait(self):
+        return self.value
+
+    def is_done(self) -> bool:
+        return True
+
+
+class StubTextChange:
+    def __init__(self, start: int, end: int, content: str):
+        self.start = start
+        self.end = end
+        self.content = content
+
+    def is_empty(self) -> bool:
+        return self.start == self.end and not self.content
+
+
+class StubCursorEvent:
+    def __init__(self, buffer: str, user: str, start, end):
+        self.buffer = buffer
+        self.user = user
+        self.start = start
+        self.end = end
+
+
+class StubController:
+    def __init__(self):
+        self.queue: deque = deque()
+        self.sent: list = []
+        self._cb = None
+
+    def push(self, item):
+        self.queue.append(item)
+        if self._cb is not None:
+            self._cb(self)
+
+    def try_recv(self) -> StubPromise:
+        return StubPromise(self.queue.popleft() if self.queue else None)
+
+    def callback(self, cb):
+        self._cb = cb
+
+    def clear_callback(self):
+        self._cb = None
+
+    def stop(self) -> bool:
+        return True
+
+
+class StubBufferController(StubController):
+    def __init__(self, path: str):
+        super().__init__()
+        self._path = path
+
+    def path(self) -> str:
+        return self._path
+
+    def content(self) -> StubPromise:
+        return StubPromise("")
+
+    def send(self, start: int, end: int, content: str) -> StubPromise:
+        self.sent.append((start, end, content))
+        return StubPromise()
+
+
+class StubCursorController(StubController):
+    def send(self, buffer: str, start, end) -> StubPromise:
+        self.sent.append((buffer, start, end))
+        return StubPromise()
+
+
+class StubWorkspace(StubController):
+    def __init__(self, id: str):
+        super().__init__()
+        self._id = id
+        self._cursor = StubCursorController()
+        self.buffers: dict[str, StubBufferController] = {}
+
+    def id(self) -> str:
+        return self._id
+
+    def cursor(self) -> StubCursorController:
+        return self._cursor
+
+    def fetch_buffers(self) -> StubPromise:
+        return StubPromise()
+
+    def fetch_users(self) -> StubPromise:
+        return StubPromise()
+
+    def user_list(self) -> list:
+        return []
+
+    def filetree(self, filter=None, strict=False) -> list[str]:
+        return [b for b in self.buffers if filter is None or b.startswith(filter)]
+
+    def detach(self, path: str) -> bool:
+        return self.buffers.pop(path, None) is not None
+
+
+class Replayer:
+    def __init__(
+        self,
+        path: str,
+        client: VirtualClient,
+        window: sublime.Window,
+        speed: float = 1.0,
+    ):
+        # a speed of 0 replays everything as fast as possible.
+        self.path = path
+        self.client = client
+        self.window = window
+        self.speed = speed
+        self.handle = StubWorkspace(f"replay-{int(time.time())}")
+        self.vws: Optional[VirtualWorkspace] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # imported here, the workspace module itself depends on this one.
+        from .workspace import VirtualWorkspace
+
+        self.vws = VirtualWorkspace(
+            self.handle,  # pyright: ignore
+            self.window,
+            self.client.executor,
+            self.client.rtt,
+        )
+        # a thread of its own, so the pacing is not skewed by the executor.
+        threading.Thread(target=self._run, name="codemp-replay", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _buffer(self, id: str) -> VirtualBuffer:
+        assert self.vws is not None
+        vbuff = self.vws.buff_by_id(id)
+        if vbuff is None:
+            buffctl = StubBufferController(id)
+            self.handle.buffers[id] = buffctl
+            vbuff = self.vws.install_buffer(buffctl)  # pyright: ignore
+            self.client.register_buffer(self.vws, vbuff)
+        return vbuff
+
+    def _run(self):
+        assert self.vws is not None
+        count = 0
+        start = time.monotonic()
+        try:
+            for ts, kind, fields in read_records(self.path):
+                if self._stop.is_set():
+                    break
+                if self.speed > 0:
+                    delay = start + ts / self.speed - time.monotonic()
+                    if delay > 0:
+                        self._stop.wait(delay)
+
+                vbuff = self._buffer(fields[0])
+                if kind == KIND_REMOTE_CHANGE:
+                    vbuff.buffctl.push(StubTextChange(*fields[1:]))  # pyright: ignore
+                elif kind == KIND_CURSOR:
+                    self.handle.cursor().push(StubCursorEvent(*fields))
+                elif kind == KIND_LOCAL_CHANGE:
+                    # goes through the view as if it had been typed.
+                    vbuff.view.run_command(
+                        "codemp_replace_text",
+                        {
+                            "start": fields[1],
+                            "end": fields[2],
+                            "content": fields[3],
+                            "change_id": vbuff.view.change_id(),
+                            "local": True,
+                        },
+                    )
+                count += 1
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"replay of '{self.path}' failed: {e}")
+        finally:
+            elapsed = time.monotonic() - start
+            sent = sum(len(b.sent) for b in self.handle.buffers.values())
+            logger.info(
+                f"replayed {count} events from '{self.path}' in {elapsed:.2f}s, "
+                f"{sent} changes sent back."
+            )
+            sublime.set_timeout(self._teardown)
+
+    def _teardown(self):
+        assert self.vws is not None
+        for vbuff in self.vws.all_buffers():
+            self.client.unregister_buffer(vbuff)
+        self.vws.uninstall()
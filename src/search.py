@@ -0,0 +1,131 @@
+from __future__ import annotations
+from typing import NamedTuple
+
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SearchMatch(NamedTuple):
+    buffer: str
+    offset: int
+    row: int
+    col: int
+    line: str
+    score: int
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+# An in-memory trigram index over the content of the buffers of a workspace.
+# Documents are indexed lowercased, a query first narrows down the candidates
+# through the trigrams it contains and then verifies them with a plain scan.
+class TrigramIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs: dict[str, str] = {}
+        self._grams: dict[str, set[str]] = {}
+        self._doc_grams: dict[str, set[str]] = {}
+        # documents whose content changed since they were indexed.
+        self._stale: set[str] = set()
+
+    def __contains__(self, doc: str) -> bool:
+        return doc in self._docs
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, doc: str, text: str):
+        grams = trigrams(text.lower())
+        with self._lock:
+            self._drop(doc)
+            self._docs[doc] = text
+            self._doc_grams[doc] = grams
+            for gram in grams:
+                self._grams.setdefault(gram, set()).add(doc)
+            self._stale.discard(doc)
+
+    def remove(self, doc: str):
+        with self._lock:
+            self._drop(doc)
+
+    def retain(self, docs):
+        keep = set(docs)
+        with self._lock:
+            for doc in [d for d in self._docs if d not in keep]:
+                self._drop(doc)
+
+    def invalidate(self, doc: str):
+        # cheap enough to be called on every change, the document
+        # is reindexed lazily before the next query.
+        with self._lock:
+            if doc in self._docs:
+                self._stale.add(doc)
+
+    def stale(self) -> set[str]:
+        with self._lock:
+            return set(self._stale)
+
+    def search(self, query: str, limit: int = 500) -> list[SearchMatch]:
+        if not query:
+            return []
+        needle = query.lower()
+
+        with self._lock:
+            if len(needle) >= 3:
+                candidates = None
+                for gram in trigrams(needle):
+                    docs = self._grams.get(gram, set())
+                    candidates = docs if candidates is None else candidates & docs
+                    if not candidates:
+                        return []
+            else:
+                candidates = set(self._docs)
+            texts = {doc: self._docs[doc] for doc in candidates}
+
+        matches: list[SearchMatch] = []
+        for doc, text in texts.items():
+            matches.extend(_scan(doc, text, query, needle))
+
+        # exact case matches first, then buffers with many hits.
+        hits: dict[str, int] = {}
+        for m in matches:
+            hits[m.buffer] = hits.get(m.buffer, 0) + 1
+        matches.sort(key=lambda m: (-m.score, -hits[m.buffer], m.buffer, m.offset))
+        return matches[:limit]
+
+    # expects the lock to be held.
+    def _drop(self, doc: str):
+        for gram in self._doc_grams.pop(doc, ()):
+            docs = self._grams.get(gram)
+            if docs is not None:
+                docs.discard(doc)
+                if not docs:
+                    del self._grams[gram]
+        self._docs.pop(doc, None)
+        self._stale.discard(doc)
+
+
+def _scan(doc: str, text: str, query: str, needle: str):
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # some characters change length when lowercased, offsets would drift.
+        lowered, needle = text, query
+    pos = lowered.find(needle)
+    row, row_start, counted = 0, 0, 0
+    while pos != -1:
+        row += text.count("\n", counted, pos)
+        counted = pos
+        row_start = text.rfind("\n", 0, pos) + 1
+        row_end = text.find("\n", pos)
+        if row_end == -1:
+            row_end = len(text)
+
+        score = 2 if text.startswith(query, pos) else 1
+        yield SearchMatch(
+            doc, pos, row, pos - row_start, text[row_start:row_end], score
+        )
+        pos = lowered.find(needle, pos + len(needle))
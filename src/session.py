@@ -0,0 +1,232 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional
+from contextlib import contextmanager
+
+import sublime
+import threading
+import logging
+import json
+import time
+import os
+
+from .utils import project_batch
+
+if TYPE_CHECKING:
+    from .client import VirtualClient
+    from .buffers import VirtualBuffer
+
+logger = logging.getLogger(__name__)
+
+SESSION_VERSION = 1
+# how long the layout has to stay put before it is written again.
+SAVE_DELAY_MS = 2000
+
+_paused = 0
+_save_generation = 0
+_last_saved: Optional[dict] = None
+
+
+@contextmanager
+def paused():
+    # while tearing everything down (disconnecting, closing a window, exiting)
+    # views go away one by one: the session on disk must keep the layout as
+    # it was before, not whatever is left at the last deactivation.
+    global _paused
+    _paused += 1
+    try:
+        yield
+    finally:
+        _paused -= 1
+
+
+def session_path() -> str:
+    return os.path.join(sublime.cache_path(), "codemp", "session.json")
+
+
+def snapshot(client: VirtualClient) -> Optional[dict]:
+    if client.codemp is None or client.stand_in:
+        return None
+
+    windows = sublime.windows()
+    layout: dict[int, list] = {}
+    for vws in client.all_workspaces():
+        if vws.window not in windows:
+            continue
+        active = vws.window.active_view()
+        buffers = [
+            {
+                "id": vbuff.id,
+                "viewport": list(vbuff.view.viewport_position()),
+                "selection": [[r.a, r.b] for r in vbuff.view.sel()],
+                "active": vbuff.view == active,
+            }
+            for vbuff in vws.all_buffers()
+        ]
+        layout.setdefault(windows.index(vws.window), []).append(
+            {"id": vws.id, "buffers": buffers}
+        )
+
+    return {
+        "version": SESSION_VERSION,
+        "host": client.host,
+        "user": client.user,
+        "windows": [
+            {"index": index, "workspaces": workspaces}
+            for index, workspaces in sorted(layout.items())
+        ],
+    }
+
+
+def save(client: VirtualClient):
+    if _paused:
+        return
+    session = snapshot(client)
+    if session is None:
+        return
+    _write(session)
+
+
+def save_soon(client: VirtualClient):
+    # for changes of the layout that happen all the time (focus, scrolling,
+    # selections): saved once things settle, only if something changed,
+    # and written from the async thread rather than the ui one.
+    global _save_generation
+    _save_generation += 1
+    generation = _save_generation
+
+    def _():
+        if generation != _save_generation or _paused:
+            return
+        session = snapshot(client)
+        if session is not None and session != _last_saved:
+            sublime.set_timeout_async(lambda: _write(session))
+
+    sublime.set_timeout(_, SAVE_DELAY_MS)
+
+
+def _write(session: dict):
+    global _last_saved
+    _last_saved = session
+    path = session_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(session, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"could not save the codemp session: {e}")
+
+
+def clear():
+    global _last_saved, _save_generation
+    _last_saved = None
+    _save_generation += 1
+    try:
+        os.remove(session_path())
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"could not clear the codemp session: {e}")
+
+
+def load() -> Optional[dict]:
+    try:
+        with open(session_path()) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"ignoring unreadable codemp session: {e}")
+        return None
+    if session.get("version") != SESSION_VERSION or not session.get("windows"):
+        return None
+    return session
+
+
+def _restore_view(vbuff: VirtualBuffer, state: dict):
+    view = vbuff.view
+    view.sel().clear()
+    for a, b in state.get("selection", []):
+        view.sel().add(sublime.Region(a, b))
+    view.set_viewport_position(tuple(state.get("viewport", (0, 0))), False)
+
+
+# Reconnects and brings back every workspace and buffer of a saved session.
+# All the joins are issued at once, and so are all the attaches, so the whole
+# restore costs roughly two round-trips plus the buffer contents.
+def restore(
+    client: VirtualClient,
+    session: dict,
+    windows: list[sublime.Window],
+    password: str,
+):
+    start = time.perf_counter()
+    client.connect(session["host"], session["user"], password)
+    assert client.codemp is not None
+
+    joins = []
+    attaches = []
+    # one more than the buffers, released once every attach has been handled,
+    # so that we finish exactly once, after the last view is populated.
+    pending = 1
+    lock = threading.Lock()
+    focus: list = []
+
+    def release():
+        nonlocal pending
+        with lock:
+            pending -= 1
+            done = pending == 0
+        if done:
+            sublime.set_timeout(finish)
+
+    def restored(vbuff: VirtualBuffer, state: dict, window: sublime.Window):
+        _restore_view(vbuff, state)
+        if state.get("active"):
+            focus.append((window, vbuff.view))
+        release()
+
+    def finish():
+        for window, view in focus:
+            window.focus_view(view)
+        elapsed = time.perf_counter() - start
+        msg = (
+            f"session restored: {len(joins)} workspaces, "
+            f"{len(attaches)} buffers in {elapsed:.2f}s"
+        )
+        logger.info(msg)
+        sublime.status_message(f"[codemp] {msg}")
+
+    for entry, window in zip(session["windows"], windows):
+        for ws in entry["workspaces"]:
+            joins.append((ws, window, client.codemp.join_workspace(ws["id"])))
+
+    # the folders of every workspace go into the project in one write.
+    with project_batch():
+        for ws, window, promise in joins:
+            try:
+                client.install_workspace(promise.wait(), window)
+            except Exception as e:
+                logger.error(f"could not rejoin workspace '{ws['id']}': {e}")
+                continue
+            vws = client.workspace_from_id(ws["id"])
+            assert vws is not None
+            for state in ws["buffers"]:
+                attaches.append((vws, window, state, vws.codemp.attach(state["id"])))
+
+        with lock:
+            pending += len(attaches)
+        for vws, window, state, promise in attaches:
+            try:
+                buffctl = promise.wait()
+            except Exception as e:
+                logger.error(f"could not reattach to '{state['id']}': {e}")
+                release()
+                continue
+            vbuff = vws.install_buffer(
+                buffctl,
+                lambda vbuff, state=state, window=window: restored(vbuff, state, window),
+                failed=lambda vbuff: release(),
+            )
+            client.register_buffer(vws, vbuff)
+    release()
@@ -0,0 +1,201 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import sublime
+import threading
+import tracemalloc
+import logging
+import time
+import gc
+
+from . import fake_codemp
+from .client import use_backend
+from .utils import live_instances, show_report
+
+if TYPE_CHECKING:
+    from .client import VirtualClient
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+# Drives the real client against the fake codemp server for a long time,
+# periodically sampling memory, live bridge objects, queue depths and latency.
+# Every `churn_every` samples a workspace is left and joined again, so that
+# teardown paths get exercised as well and leaks show up in the counts.
+class SoakRun:
+    def __init__(
+        self,
+        client: VirtualClient,
+        window: sublime.Window,
+        duration: float = 3600,
+        workspaces: int = 2,
+        buffers: int = 10,
+        peers: int = 3,
+        rtt_ms: float = 50,
+        jitter_ms: float = 10,
+        loss: float = 0.01,
+        edit_rate: float = 5,
+        cursor_rate: float = 5,
+        sample_interval: float = 30,
+        churn_every: int = 10,
+    ):
+        self.client = client
+        self.window = window
+        self.duration = duration
+        self.workspaces = [f"soak-{i}" for i in range(workspaces)]
+        self.buffers = [f"file-{i}.txt" for i in range(buffers)]
+        self.peer_count = peers
+        self.network = fake_codemp.Network(rtt_ms, jitter_ms, loss)
+        self.server = fake_codemp.Server(self.network)
+        self.edit_rate = edit_rate
+        self.cursor_rate = cursor_rate
+        self.sample_interval = sample_interval
+        self.churn_every = churn_every
+
+        self.samples: list[dict] = []
+        self.leaks: dict[str, int] = {}
+        self._stop = threading.Event()
+        self._baseline = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name="codemp-soak", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self._baseline = tracemalloc.get_traced_memory()[0]
+
+        for ws in self.workspaces:
+            sws = self.server.workspace(ws)
+            for path in self.buffers:
+                sws.buffers[path] = ""
+
+        fake_codemp.SERVER = self.server
+        use_backend(fake_codemp)
+        peers: list[fake_codemp.Peer] = []
+        try:
+            self.client.connect("fake://soak", "soak", "")
+            for ws in self.workspaces:
+                self._join(ws)
+            for ws in self.workspaces:
+                for i in range(self.peer_count):
+                    peer = fake_codemp.Peer(
+                        self.server, ws, f"peer-{i}", self.edit_rate, self.cursor_rate
+                    )
+                    peer.start()
+                    peers.append(peer)
+
+            deadline = time.monotonic() + self.duration
+            while not self._stop.wait(self.sample_interval):
+                if self.churn_every and (len(self.samples) + 1) % self.churn_every == 0:
+                    self._churn(self.workspaces[len(self.samples) % len(self.workspaces)])
+                self._sample(peers)
+                if time.monotonic() > deadline:
+                    break
+        except Exception as e:
+            logger.exception(f"soak run failed: {e}")
+        finally:
+            for peer in peers:
+                peer.stop()
+            self.client.disconnect()
+            use_backend(None)
+            fake_codemp.SERVER = None
+            self.network.stop()
+
+            # give the views a moment to close before looking for leftovers.
+            time.sleep(1)
+            gc.collect()
+            self.leaks = {
+                name: len(objs)
+                for name, objs in live_instances().items()
+                if objs and name != "VirtualClient"
+            }
+            if started_tracing:
+                tracemalloc.stop()
+            sublime.set_timeout(self._report)
+
+    def _join(self, id: str):
+        assert self.client.codemp is not None
+        handle = self.client.codemp.join_workspace(id).wait()
+        self.client.install_workspace(handle, self.window)
+        vws = self.client.workspace_from_id(id)
+        assert vws is not None
+        for path in handle.filetree(None):
+            vbuff = vws.install_buffer(handle.attach(path).wait())
+            self.client.register_buffer(vws, vbuff)
+
+    def _churn(self, id: str):
+        assert self.client.codemp is not None
+        vws = self.client.workspace_from_id(id)
+        if vws is None:
+            return
+        logger.debug(f"soak: leaving and rejoining '{id}'")
+        self.client.codemp.leave_workspace(id)
+        self.client.uninstall_workspace(vws)
+        del vws
+        self._join(id)
+
+    def _sample(self, peers):
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        live = {name: len(objs) for name, objs in live_instances().items()}
+        latencies = self.server.take_latencies()
+        sample = {
+            "t": len(self.samples) * self.sample_interval,
+            "memory_kb": (current - self._baseline) / 1024,
+            "peak_kb": (peak - self._baseline) / 1024,
+            "buffers": live.get("VirtualBuffer", 0),
+            "buffers_expected": len(self.client.all_buffers()),
+            "workspaces": live.get("VirtualWorkspace", 0),
+            "workspaces_expected": len(self.client.all_workspaces()),
+            "queues": {
+                lane: stats["depth"]
+                for lane, stats in self.client.executor.stats().items()
+            },
+            "network": self.network.depth(),
+            "events": len(latencies),
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies, default=0) * 1000,
+            "edits": sum(p.edits for p in peers),
+        }
+        self.samples.append(sample)
+        logger.info(f"soak sample: {sample}")
+
+    def _report(self):
+        lines = [
+            f"soak run: {len(self.samples)} samples every {self.sample_interval}s",
+            "",
+            "t(s)   mem(kB)  peak(kB)  vbuf  vws  queues(e/c/m)  net  events  "
+            "p50(ms)  p99(ms)  max(ms)",
+        ]
+        for s in self.samples:
+            q = s["queues"]
+            lines.append(
+                f"{s['t']:<6.0f} {s['memory_kb']:<8.0f} {s['peak_kb']:<9.0f} "
+                f"{s['buffers']}/{s['buffers_expected']:<3} "
+                f"{s['workspaces']}/{s['workspaces_expected']:<2} "
+                f"{q.get('edits', 0)}/{q.get('cursors', 0)}/{q.get('meta', 0):<9} "
+                f"{s['network']:<4} {s['events']:<7} {s['p50_ms']:<8.1f} "
+                f"{s['p99_ms']:<8.1f} {s['max_ms']:.1f}"
+            )
+        if len(self.samples) > 1:
+            growth = self.samples[-1]["memory_kb"] - self.samples[0]["memory_kb"]
+            lines += ["", f"memory growth: {growth:.0f}kB"]
+        lines += [
+            "",
+            "leaked after disconnect: "
+            + (", ".join(f"{n}: {c}" for n, c in self.leaks.items()) or "none"),
+        ]
+        show_report(self.window, "codemp soak report", "\n".join(lines) + "\n")
@@ -1,6 +1,11 @@
 import sublime
 import sublime_plugin
-from typing import Dict, Generic, TypeVar
+import threading
+import os
+import weakref
+import difflib
+from contextlib import contextmanager
+from typing import Dict, Generic, List, Optional, TypeVar
 from . import globals as g
 
 # bidirectional dictionary so that we can have bidirectional
@@ -54,6 +59,63 @@ class bidict(dict, Generic[K, V]):
         super(bidict, self).clear()
 
 
+# Every write of the project data makes sublime rebuild the sidebar and rescan
+# its folders, so changes to the workspace folders can be collected in a batch
+# and written once per window when the outermost batch closes.
+_project_batch = threading.local()
+
+
+@contextmanager
+def project_batch():
+    outer = getattr(_project_batch, "pending", None) is None
+    if outer:
+        _project_batch.pending = {}
+    try:
+        yield
+    finally:
+        if outer:
+            pending, _project_batch.pending = _project_batch.pending, None
+            for window, folders in pending.values():
+                _write_project_folders(window, folders)
+
+
+def set_project_folder(window, name: str, path: Optional[str]):
+    # a path of None removes the folder.
+    pending = getattr(_project_batch, "pending", None)
+    if pending is None:
+        _write_project_folders(window, {name: path})
+    else:
+        pending.setdefault(window.id(), (window, {}))[1][name] = path
+
+
+def _write_project_folders(window, changes):
+    proj = window.project_data()
+    if proj is None:
+        proj = {"folders": []}
+    folders = proj.get("folders", [])
+
+    updated = [f for f in folders if f.get("name", "") not in changes]
+    updated += [{"name": n, "path": p} for n, p in changes.items() if p is not None]
+    if updated == folders:
+        return
+
+    proj["folders"] = updated
+    window.set_project_data(proj)
+
+
+# weak references to the instances of the bridge classes, so that leaks
+# can be spotted: once cleaned up, nothing should keep them alive.
+_live_instances: Dict[str, weakref.WeakSet] = {}
+
+
+def track_instance(obj):
+    _live_instances.setdefault(type(obj).__name__, weakref.WeakSet()).add(obj)
+
+
+def live_instances() -> Dict[str, list]:
+    return {name: list(objs) for name, objs in _live_instances.items()}
+
+
 def status_log(msg, popup=False):
     sublime.status_message("[codemp] {}".format(msg))
     print("[codemp] {}".format(msg))
@@ -77,6 +139,156 @@ def safe_listener_attach(txt_listener: sublime_plugin.TextChangeListener, buffer
         txt_listener.attach(buffer)
 
 
+def rebase_changes(changes):
+    # turns changes that each apply to the text left by the previous ones
+    # (as sublime reports them) into non overlapping edits that all apply to
+    # the text before the first change. edits that touch are merged into one.
+    edits: List[list] = []
+    for start, end, text in changes:
+        # skip the edits that end before the change, keeping track of how much
+        # they shifted the text.
+        i, shift = 0, 0
+        while i < len(edits):
+            o_start, o_end, o_text = edits[i]
+            if o_start + shift + len(o_text) >= start:
+                break
+            shift += len(o_text) - (o_end - o_start)
+            i += 1
+
+        # merge with every edit the change overlaps or touches.
+        new_start, new_end = start - shift, None
+        prefix = suffix = ""
+        j = i
+        while j < len(edits):
+            o_start, o_end, o_text = edits[j]
+            cur_start = o_start + shift
+            if cur_start > end:
+                break
+            cur_end = cur_start + len(o_text)
+            if j == i and start > cur_start:
+                new_start = o_start
+                prefix = o_text[: start - cur_start]
+            if end < cur_end:
+                new_end = o_end
+                suffix = o_text[end - cur_start :]
+            shift += len(o_text) - (o_end - o_start)
+            j += 1
+
+        if new_end is None:
+            new_end = end - shift
+        edits[i:j] = [[new_start, new_end, prefix + text + suffix]]
+
+    return [(s, e, t) for s, e, t in edits if s != e or t]
+
+
+def apply_edits(text: str, edits) -> str:
+    # applies non overlapping, sorted edits that are all relative to `text`.
+    parts, last = [], 0
+    for start, end, new in edits:
+        parts.append(text[last:start])
+        parts.append(new)
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def _common_prefix(a: str, b: str) -> int:
+    # bisecting on slice comparisons keeps the scanning in C,
+    # which matters with megabytes on both sides.
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    lo, hi = 0, min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid :] == b[len(b) - mid :]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def minimal_edits(
+    old: str,
+    new: str,
+    offset: int = 0,
+    line_diff_from: int = 1024,
+    max_lines: int = 1000,
+):
+    # the sorted, non overlapping edits, relative to `old` shifted by `offset`,
+    # that turn it into `new`. the common head and tail are trimmed first,
+    # what is left is diffed line by line if it is still large. a diff of
+    # more than `max_lines` lines on both sides would take too long: the
+    # trimmed middle is then sent as it is.
+    prefix = _common_prefix(old, new)
+    suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
+    old_mid = old[prefix : len(old) - suffix]
+    new_mid = new[prefix : len(new) - suffix]
+    start = offset + prefix
+    if not old_mid and not new_mid:
+        return []
+    if min(len(old_mid), len(new_mid)) < line_diff_from:
+        return [(start, start + len(old_mid), new_mid)]
+
+    # whole lines on both sides, or they would not line up.
+    prefix = old.rfind("\n", 0, prefix) + 1
+    while suffix and (old[-suffix - 1] != "\n" or new[-suffix - 1] != "\n"):
+        nl = old.find("\n", len(old) - suffix)
+        suffix = 0 if nl == -1 else len(old) - nl - 1
+    old_mid = old[prefix : len(old) - suffix]
+    new_mid = new[prefix : len(new) - suffix]
+    start = offset + prefix
+
+    old_lines = old_mid.splitlines(keepends=True)
+    new_lines = new_mid.splitlines(keepends=True)
+    old_at = [0]
+    for line in old_lines:
+        old_at.append(old_at[-1] + len(line))
+    new_at = [0]
+    for line in new_lines:
+        new_at.append(new_at[-1] + len(line))
+
+    if len(old_lines) == len(new_lines):
+        # reindenting, reformatting: lines changed in place, compared pairwise.
+        return _line_edits(start, old_lines, new_lines, old_at)
+    if min(len(old_lines), len(new_lines)) > max_lines:
+        return [(start, start + len(old_mid), new_mid)]
+
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [
+        (start + old_at[i1], start + old_at[i2], new_mid[new_at[j1] : new_at[j2]])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def _line_edits(start: int, old_lines: list, new_lines: list, old_at: list):
+    edits = []
+    for i, (old, new) in enumerate(zip(old_lines, new_lines)):
+        if old == new:
+            continue
+        prefix = 0
+        while prefix < min(len(old), len(new)) and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        while (
+            suffix < min(len(old), len(new)) - prefix
+            and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]
+        ):
+            suffix += 1
+        at = start + old_at[i]
+        edits.append((at + prefix, at + len(old) - suffix, new[prefix : len(new) - suffix]))
+    return edits
+
+
 def get_contents(view):
     r = sublime.Region(0, view.size())
     return view.substr(r)
@@ -94,6 +306,24 @@ def populate_view(view, content):
     )
 
 
+def show_report(window, title, text):
+    view = window.new_file()
+    view.set_scratch(True)
+    view.set_name(title)
+    view.run_command("append", {"characters": text})
+    view.set_read_only(True)
+    return view
+
+
+def path_within(root: str, path: str) -> Optional[str]:
+    # where a buffer path of the server lands under `root`, or None if it
+    # would end up outside of it (e.g. through "..").
+    target = os.path.realpath(os.path.join(root, path.lstrip("/")))
+    if not target.startswith(os.path.realpath(root) + os.sep):
+        return None
+    return target
+
+
 def get_view_from_local_path(path):
     for window in sublime.windows():
         for view in window.views():
@@ -101,17 +331,39 @@ def get_view_from_local_path(path):
                 return view
 
 
-def draw_cursor_region(view, start, end, user):
-    reg = rowcol_to_region(view, start, end)
-    reg_flags = sublime.RegionFlags.DRAW_EMPTY
+def get_setting(key, default=None):
+    return sublime.load_settings(g.SETTINGS_FILE).get(key, default)
+
+
+def cursor_region_key(user):
+    return f"{g.SUBLIME_REGIONS_PREFIX}-{hash(user)}"
 
+
+def draw_cursor_region(view, region, user, detail=g.CURSOR_DETAIL_FULL, minimap=True):
     user_hash = hash(user)
+    scope = g.REGIONS_COLORS[user_hash % len(g.REGIONS_COLORS)]
+    extra = sublime.RegionFlags.NONE if minimap else sublime.RegionFlags.HIDE_ON_MINIMAP
+
+    if detail == g.CURSOR_DETAIL_MARKER:
+        # past a certain amount of cursors we only hint at where they are.
+        view.add_regions(
+            cursor_region_key(user),
+            [region],
+            flags=sublime.RegionFlags.DRAW_EMPTY
+            | sublime.RegionFlags.DRAW_NO_FILL
+            | sublime.RegionFlags.DRAW_NO_OUTLINE
+            | extra,
+            scope=scope,
+            icon="dot",
+        )
+        return
 
+    annotations = [user] if detail == g.CURSOR_DETAIL_FULL else []
     view.add_regions(
-        f"{g.SUBLIME_REGIONS_PREFIX}-{user_hash}",
-        [reg],
-        flags=reg_flags,
-        scope=g.REGIONS_COLORS[user_hash % len(g.REGIONS_COLORS)],
-        annotations=[user],  # pyright: ignore
+        cursor_region_key(user),
+        [region],
+        flags=sublime.RegionFlags.DRAW_EMPTY | extra,
+        scope=scope,
+        annotations=annotations,  # pyright: ignore
         annotation_color=g.PALETTE[user_hash % len(g.PALETTE)],
     )
@@ -1,16 +1,26 @@
 from __future__ import annotations
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from ..listeners import CodempClientTextChangeListener
 import sublime
 import shutil
+import os
 import tempfile
+import threading
 import logging
+import time
 
-import codemp
 from . import globals as g
 from .buffers import VirtualBuffer
-from .utils import draw_cursor_region
+from .executor import PriorityExecutor, LANE_CURSORS, LANE_META
+from .latency import RttEstimator
+from .utils import set_project_folder, get_setting, track_instance, path_within
+from .search import TrigramIndex
+from . import recorder
+
+if TYPE_CHECKING:
+    import codemp
+    from .follow import Follower
 
 logger = logging.getLogger(__name__)
 
@@ -23,16 +33,47 @@ def make_cursor_callback(workspace: VirtualWorkspace):
                 if event is None:
                     break
 
+                if recorder.RECORDER is not None:
+                    recorder.RECORDER.cursor(
+                        event.buffer, event.user, event.start, event.end
+                    )
+
+                if event.user not in workspace.users:
+                    workspace.user_seen(event.user)
+                touches = workspace.touches.setdefault(event.user, {})
+                touches[event.buffer] = touches.get(event.buffer, 0) + 1
+
+                follower = workspace.follower
+                if follower is not None:
+                    follower.on_cursor(event)
+
                 vbuff = workspace.buff_by_id(event.buffer)
                 if vbuff is None:
-                    logger.warning(
-                        f"{workspace.id} received a cursor event for a buffer that wasn't saved internally."
-                    )
+                    # someone is in a buffer we are not attached to.
                     continue
 
-                draw_cursor_region(vbuff.view, event.start, event.end, event.user)
+                vbuff.cursors.update(event.user, event.start, event.end)
+
+        workspace.executor.submit(LANE_CURSORS, _)
+
+    return _callback
+
+
+def event_kind(event) -> str:
+    # the bindings expose the variants of the workspace event enum as
+    # subclasses (e.g. `Event_FileTreeUpdated`) carrying their value as `_0`.
+    return type(event).__name__.rsplit("_", 1)[-1]
+
+
+def make_event_callback(workspace: VirtualWorkspace):
+    def _callback(ws: codemp.Workspace):
+        def _():
+            while event := ws.try_recv().wait():
+                if event is None:
+                    break
+                workspace.apply_event(event_kind(event), event._0)
 
-        sublime.set_timeout_async(_)
+        workspace.executor.submit(LANE_META, _)
 
     return _callback
 
@@ -40,32 +81,66 @@ def make_cursor_callback(workspace: VirtualWorkspace):
 # A virtual workspace is a bridge class that aims to translate
 # events that happen to the codemp workspaces into sublime actions
 class VirtualWorkspace:
-    def __init__(self, handle: codemp.Workspace, window: sublime.Window):
+    def __init__(
+        self,
+        handle: codemp.Workspace,
+        window: sublime.Window,
+        executor: PriorityExecutor,
+        rtt: RttEstimator,
+    ):
         self.codemp: codemp.Workspace = handle
         self.window: sublime.Window = window
+        self.executor = executor
+        self.rtt = rtt
         self.curctl: codemp.CursorController = self.codemp.cursor()
 
         self.id: str = self.codemp.id()
 
-        self.codemp.fetch_buffers()
-        self.codemp.fetch_users()
-
         self._id2buff: dict[str, VirtualBuffer] = {}
 
-        tmpdir = tempfile.mkdtemp(prefix="codemp_")
-        self.rootdir = tmpdir
-
-        proj: dict = self.window.project_data()  # pyright: ignore
-        if proj is None:
-            proj = {"folders": []}  # pyright: ignore, Value can be None
-
-        proj["folders"].append(
-            {"name": f"{g.WORKSPACE_FOLDER_PREFIX}{self.id}", "path": self.rootdir}
+        # what exists in the workspace and who is in it, kept current by the
+        # workspace events so that commands can answer without a round-trip.
+        # both are replaced rather than mutated under the lock, so readers
+        # get a consistent snapshot without taking it.
+        self._tables_lock = threading.Lock()
+        self.filetree: frozenset[str] = frozenset()
+        self.users: frozenset[str] = frozenset()
+        # user -> buffer -> cursor events seen there, and who we follow.
+        self.touches: dict[str, dict[str, int]] = {}
+        self.follower: Optional[Follower] = None
+
+        self.search_index = TrigramIndex()
+
+        # in memory mode the buffers are never backed by files on disk,
+        # so there is no folder to show either.
+        self.rootdir: Optional[str] = None
+        if not get_setting("in_memory_buffers", False):
+            self.rootdir = tempfile.mkdtemp(prefix="codemp_")
+        # the folder is only shown in the sidebar once there is something in it.
+        self.folder_shown = False
+        # every buffer of the workspace has an empty file standing in for it
+        # in the folder, so goto anything can find them. opening one attaches.
+        self.placeholders = self.rootdir is not None and get_setting(
+            "placeholder_tree", True
         )
-        self.window.set_project_data(proj)
 
-        self.curctl.callback(make_cursor_callback(self))
+        # only the latest cursor position is published, at most once per interval.
+        self._cursor_lock = threading.Lock()
+        self._cursor_pending: Optional[tuple] = None
+        self._cursor_scheduled = False
+        self._cursor_last_sent = 0.0
+        self._cursor_probing = False
+
         self.isactive = True
+        self.curctl.callback(make_cursor_callback(self))
+        self.codemp.callback(make_event_callback(self))
+        self.executor.submit(
+            LANE_META,
+            self._seed_tables,
+            self.codemp.fetch_buffers(),
+            self.codemp.fetch_users(),
+        )
+        track_instance(self)
 
     def __del__(self):
         logger.debug("workspace destroyed!")
@@ -75,7 +150,9 @@ class VirtualWorkspace:
         return hash(self.id)
 
     def uninstall(self):
+        self.follower = None
         self.curctl.clear_callback()
+        self.codemp.clear_callback()
         self.isactive = False
         self.curctl.stop()
 
@@ -86,22 +163,121 @@ class VirtualWorkspace:
                     f"could not detach from '{vbuff.id}' for workspace '{self.id}'."
                 )
         self._id2buff.clear()
+        self.hide_folder()
 
-        proj: dict = self.window.project_data()  # type:ignore
-        if proj is None:
-            raise
-
-        clean_proj_folders = list(
-            filter(
-                lambda f: f.get("name", "") != f"{g.WORKSPACE_FOLDER_PREFIX}{self.id}",
-                proj["folders"],
+        logger.info(f"cleaning up virtual workspace '{self.id}'")
+        if self.rootdir is not None:
+            shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def show_folder(self):
+        if self.rootdir is not None and not self.folder_shown:
+            set_project_folder(self.window, self.folder_name(), self.rootdir)
+            self.folder_shown = True
+
+    def hide_folder(self):
+        if self.folder_shown:
+            set_project_folder(self.window, self.folder_name(), None)
+            self.folder_shown = False
+
+    def folder_name(self) -> str:
+        return f"{g.WORKSPACE_FOLDER_PREFIX}{self.id}"
+
+    def _seed_tables(self, buffers, users):
+        try:
+            buffers.wait()
+            users.wait()
+        except Exception as e:
+            logger.warning(f"could not fetch the state of workspace '{self.id}': {e}")
+            return
+        # events that arrived in the meantime are already in the local tables.
+        with self._tables_lock:
+            self.filetree = self.filetree | frozenset(self.codemp.filetree(None))
+            self.users = self.users | frozenset(
+                user.name for user in self.codemp.user_list()
             )
-        )
-        proj["folders"] = clean_proj_folders
-        self.window.set_project_data(proj)
 
-        logger.info(f"cleaning up virtual workspace '{self.id}'")
-        shutil.rmtree(self.rootdir, ignore_errors=True)
+        if self.placeholders:
+            # the top of the tree first, it is what shows in the sidebar.
+            paths = sorted(self.filetree, key=lambda p: (p.count("/"), p))
+            self._placeholder_chunk(paths)
+
+    def _placeholder_chunk(self, paths: list[str]):
+        # a big tree is written a chunk at a time, each its own task on the
+        # meta lane, so that it never holds up other metadata for long.
+        if not self.isactive or not paths:
+            return
+        chunk = get_setting("placeholder_chunk", 200)
+        for path in paths[:chunk]:
+            if path in self.filetree:  # it may have been deleted meanwhile.
+                self._placeholder(path, True)
+        self.show_folder()
+        if len(paths) > chunk:
+            self.executor.submit(LANE_META, self._placeholder_chunk, paths[chunk:])
+
+    def placeholder_path(self, path: str) -> Optional[str]:
+        assert self.rootdir is not None
+        return path_within(self.rootdir, path)
+
+    def _placeholder(self, path: str, exists: bool):
+        if not self.placeholders or path in self._id2buff:
+            return  # an attached buffer has the real file there.
+        target = self.placeholder_path(path)
+        if target is None:
+            logger.warning(f"no placeholder for '{path}', it points outside the workspace")
+            return
+        try:
+            if exists:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                open(target, "a").close()
+            else:
+                os.remove(target)
+        except OSError as e:
+            logger.debug(f"could not update the placeholder of '{path}': {e}")
+
+    def buffer_from_placeholder(self, filename: str) -> Optional[str]:
+        # the buffer a placeholder file stands for, if it is one of ours.
+        if not self.placeholders or self.rootdir is None:
+            return None
+        root = os.path.realpath(self.rootdir) + os.sep
+        filename = os.path.realpath(filename)
+        if not filename.startswith(root):
+            return None
+        relative = filename[len(root) :].replace(os.sep, "/")
+        for candidate in (relative, "/" + relative):
+            if candidate in self.filetree and candidate not in self._id2buff:
+                return candidate
+        return None
+
+    def user_seen(self, user: str):
+        with self._tables_lock:
+            self.users = self.users | {user}
+
+    def apply_event(self, kind: str, value: str):
+        if kind == "FileTreeUpdated":
+            # the event only names the path, the local tree of the bindings
+            # is already updated and tells whether it was created or deleted.
+            exists = value in self.codemp.filetree(value, True)
+            with self._tables_lock:
+                if exists:
+                    self.filetree = self.filetree | {value}
+                else:
+                    self.filetree = self.filetree - {value}
+            self._placeholder(value, exists)
+            if exists and self.placeholders:
+                self.show_folder()
+            logger.debug(f"{self.id}: filetree updated for '{value}'")
+        elif kind == "UserJoin":
+            self.user_seen(value)
+        elif kind == "UserLeave":
+            with self._tables_lock:
+                self.users = self.users - {value}
+            self.touches.pop(value, None)
+            if self.follower is not None and self.follower.user == value:
+                self.follower.stop()
+            for vbuff in self.all_buffers():
+                vbuff.cursors.remove(value)
+        else:
+            logger.debug(f"{self.id}: ignoring workspace event {kind}")
 
     def all_buffers(self) -> list[VirtualBuffer]:
         return list(self._id2buff.values())
@@ -110,24 +286,103 @@ class VirtualWorkspace:
         return self._id2buff.get(id)
 
     def install_buffer(
-        self, buff: codemp.BufferController, listener: CodempClientTextChangeListener
+        self,
+        buff: codemp.BufferController,
+        then: Optional[Callable[[VirtualBuffer], None]] = None,
+        failed: Optional[Callable[[VirtualBuffer], None]] = None,
     ) -> VirtualBuffer:
         logger.debug(f"installing buffer {buff.path()}")
 
         view = self.window.new_file()
-        vbuff = VirtualBuffer(buff, view, self.rootdir)
+        vbuff = VirtualBuffer(buff, view, self.rootdir, self.executor, self.rtt)
+        vbuff.index = self.search_index
         self._id2buff[vbuff.id] = vbuff
+        self.show_folder()
 
-        vbuff.sync(listener)
+        vbuff.sync(then, failed)
 
         return vbuff
 
     def uninstall_buffer(self, vbuff: VirtualBuffer):
+        # once detached we no longer hear about its changes.
+        self.search_index.invalidate(vbuff.id)
         del self._id2buff[vbuff.id]
         self.codemp.detach(vbuff.id)
         vbuff.uninstall()
+        # the buffer still exists, only we are no longer attached to it.
+        if vbuff.id in self.filetree:
+            self._placeholder(vbuff.id, True)
+
+    def fetch_contents(
+        self, paths: list[str], limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, str]]:
+        # yields (path, content) as they arrive, for any buffer of the workspace.
+        # buffers we are not attached to are attached just long enough
+        # to read their content.
+        if limit is None:
+            limit = get_setting("bulk_concurrency", 8)
+
+        def fetch(path: str) -> str:
+            vbuff = self._id2buff.get(path)
+            if vbuff is not None:
+                return vbuff.buffctl.content().wait()
+
+            buffctl = self.codemp.attach(path).wait()
+            try:
+                return buffctl.content().wait()
+            finally:
+                if path not in self._id2buff:
+                    self.codemp.detach(path)
+
+        with ThreadPoolExecutor(max_workers=limit) as pool:
+            futures = {pool.submit(fetch, path): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    yield path, future.result()
+                except Exception as e:
+                    logger.warning(f"could not fetch the content of '{path}': {e}")
 
     def send_cursor(self, id: str, start: Tuple[int, int], end: Tuple[int, int]):
-        # we can safely ignore the promise, we don't really care if everything
-        # is ok for now with the cursor.
-        self.curctl.send(id, start, end)
+        with self._cursor_lock:
+            self._cursor_pending = (id, start, end)
+            if self._cursor_scheduled:
+                return
+            self._cursor_scheduled = True
+
+        next_send = self._cursor_last_sent + self.rtt.cursor_interval()
+        delay = max(next_send - time.monotonic(), 0)
+        sublime.set_timeout(
+            lambda: self.executor.submit(LANE_CURSORS, self._publish_cursor),
+            int(delay * 1000),
+        )
+
+    def _publish_cursor(self):
+        with self._cursor_lock:
+            pending, self._cursor_pending = self._cursor_pending, None
+            self._cursor_scheduled = False
+        if pending is None or not self.isactive:
+            return
+
+        self._cursor_last_sent = time.monotonic()
+        promise = self.curctl.send(*pending)
+
+        # we don't need to wait on cursors, but one at a time we use them
+        # to keep an eye on the round-trip time, away from the cursor lane.
+        if not self._cursor_probing:
+            self._cursor_probing = True
+            self.executor.submit(
+                LANE_META, self._probe_rtt, promise, self._cursor_last_sent
+            )
+
+    def _probe_rtt(self, promise, sent_at: float):
+        try:
+            # if the answer came while the probe was waiting for a slot, we
+            # can't tell when it came: the sample would count the wait too.
+            if promise.is_done():
+                logger.debug("dropping an rtt sample, it waited on the meta lane")
+                return
+            promise.wait()
+            self.rtt.observe(time.monotonic() - sent_at)
+        finally:
+            self._cursor_probing = False
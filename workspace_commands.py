@@ -1,15 +1,49 @@
 import sublime
 import sublime_plugin
 import logging
+import time
+import re
 
 from .src.client import client
-from listeners import TEXT_LISTENER
+from .src.executor import LANE_META
+from .src.utils import get_contents
+from .src.bulk import export_workspace, share_folder, replace_in_workspace
+from .src.bulk import in_background
+from .src import session
+from .src.follow import Follower
 from input_handlers import SimpleTextInput
 from input_handlers import ActiveWorkspacesIdList
 from input_handlers import BufferIdList
 
 logger = logging.getLogger(__name__)
 
+
+def attach_buffer(window, vws, buffer_id, then=None):
+    # attaches to the buffer in the background, `then` is called on the
+    # main thread with the VirtualBuffer once its content is in the view.
+    logger.debug(f"attempting to attach to {buffer_id}...")
+    promise = vws.codemp.attach(buffer_id)
+
+    def deferred_attach(promise):
+        try:
+            buff_ctl = promise.wait()
+            logger.debug("attach successfull!")
+        except Exception as e:
+            logging.error(f"error when attaching to buffer '{buffer_id}':\n\n {e}")
+            sublime.error_message(f"Could not attach to buffer '{buffer_id}'")
+            return
+
+        vbuff = vws.install_buffer(buff_ctl, then)
+        client.register_buffer(vws, vbuff)  # we need to keep track of it.
+        session.save(client)
+
+        # TODO! if the view is already active calling focus_view()
+        # will not trigger the on_activate
+        window.focus_view(vbuff.view)
+
+    client.executor.submit(LANE_META, deferred_attach, promise)
+
+
 # Join Buffer Command
 class CodempJoinBufferCommand(sublime_plugin.WindowCommand):
     def is_enabled(self):
@@ -26,11 +60,11 @@ class CodempJoinBufferCommand(sublime_plugin.WindowCommand):
         assert vws is not None
 
         # is the buffer already installed?
-        if buffer_id in vws.codemp.buffer_list():
+        if vws.buff_by_id(buffer_id) is not None:
             logger.info("buffer already installed!")
             return  # do nothing.
 
-        if buffer_id not in vws.codemp.filetree(filter=buffer_id):
+        if buffer_id not in vws.filetree:
             create = sublime.ok_cancel_dialog(
                 "There is no buffer named '{buffer_id}' in the workspace '{workspace_id}'.\n\
                 Do you want to create it?",
@@ -46,26 +80,7 @@ class CodempJoinBufferCommand(sublime_plugin.WindowCommand):
                 create_promise.wait()
 
         # now we can defer the attaching process
-        logger.debug(f"attempting to attach to {buffer_id}...")
-        promise = vws.codemp.attach(buffer_id)
-
-        def deferred_attach(promise):
-            try:
-                buff_ctl = promise.wait()
-                logger.debug("attach successfull!")
-            except Exception as e:
-                logging.error(f"error when attaching to buffer '{id}':\n\n {e}")
-                sublime.error_message(f"Could not attach to buffer '{buffer_id}'")
-                return
-
-            vbuff = vws.install_buffer(buff_ctl, TEXT_LISTENER)
-            client.register_buffer(vws, vbuff)  # we need to keep track of it.
-
-            # TODO! if the view is already active calling focus_view()
-            # will not trigger the on_activate
-            self.window.focus_view(vbuff.view)
-
-        sublime.set_timeout_async(lambda: deferred_attach(promise))
+        attach_buffer(self.window, vws, buffer_id)
 
     def input_description(self) -> str:
         return "Attach: "
@@ -96,8 +111,9 @@ class CodempLeaveBufferCommand(sublime_plugin.WindowCommand):
             if vws.codemp.detach(buffer_id):
                 vws.uninstall_buffer(vbuff)
                 client.unregister_buffer(vbuff)
+                session.save(client)
 
-        sublime.set_timeout_async(defer_detach)
+        client.executor.submit(LANE_META, defer_detach)
 
     def input_description(self) -> str:
         return "Leave: "
@@ -157,7 +173,6 @@ class CodempDeleteBufferCommand(sublime_plugin.WindowCommand):
             logging.warning(f"You are not attached to the workspace '{workspace_id}'")
             return
 
-        fetch_promise = vws.codemp.fetch_buffers()
         delete = sublime.ok_cancel_dialog(
             f"Confirm you want to delete the buffer '{buffer_id}'",
             ok_title="delete",
@@ -165,9 +180,7 @@ class CodempDeleteBufferCommand(sublime_plugin.WindowCommand):
         )
         if not delete:
             return
-        fetch_promise.wait()
-        existing = vws.codemp.filetree(buffer_id)
-        if len(existing) == 0:
+        if buffer_id not in vws.filetree:
             sublime.error_message(
                 f"The buffer '{buffer_id}' does not exists in the workspace."
             )
@@ -186,11 +199,11 @@ class CodempDeleteBufferCommand(sublime_plugin.WindowCommand):
         vbuff = client.buffer_from_id(buffer_id)
         if vbuff is None:
             # we are not attached to it!
-            sublime.set_timeout_async(deferred_delete)
+            client.executor.submit(LANE_META, deferred_delete)
         else:
             if vws.codemp.detach(buffer_id):
                 vws.uninstall_buffer(vbuff)
-                sublime.set_timeout_async(deferred_delete)
+                client.executor.submit(LANE_META, deferred_delete)
             else:
                 logging.error(
                     f"error while detaching from buffer '{buffer_id}', aborting the delete."
@@ -206,3 +219,248 @@ class CodempDeleteBufferCommand(sublime_plugin.WindowCommand):
 
         if "buffer_id" not in args:
             return BufferIdList(args["workspace_id"])
+
+
+class CodempSearchWorkspaceCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return len(client.all_workspaces(self.window)) > 0
+
+    def run(self, workspace_id, query):  # pyright: ignore[reportIncompatibleMethodOverride]
+        vws = client.workspace_from_id(workspace_id)
+        if vws is None:
+            sublime.error_message(
+                f"You are not attached to the workspace '{workspace_id}'"
+            )
+            return
+
+        def deferred_search():
+            start = time.perf_counter()
+            index = vws.search_index
+            paths = sorted(vws.filetree)
+            index.retain(paths)
+
+            # attached buffers are refreshed straight from their view,
+            # everything else that is missing or outdated is fetched.
+            outdated = index.stale()
+            missing = []
+            for path in paths:
+                if path in index and path not in outdated:
+                    continue
+                vbuff = vws.buff_by_id(path)
+                if vbuff is not None:
+                    index.add(path, get_contents(vbuff.view))
+                else:
+                    missing.append(path)
+            for path, content in vws.fetch_contents(missing):
+                index.add(path, content)
+
+            indexed = time.perf_counter()
+            matches = index.search(query)
+            logger.debug(
+                f"search for '{query}': indexing {(indexed - start) * 1000:.1f}ms, "
+                f"query {(time.perf_counter() - indexed) * 1000:.1f}ms"
+            )
+            sublime.set_timeout(lambda: self.show_results(vws, query, matches))
+
+        in_background("search", deferred_search)
+
+    def show_results(self, vws, query, matches):
+        if not matches:
+            sublime.status_message(f"[codemp] no matches for '{query}'")
+            return
+
+        items = [
+            sublime.QuickPanelItem(
+                f"{m.buffer}:{m.row + 1}:{m.col + 1}", m.line.strip()
+            )
+            for m in matches
+        ]
+
+        def on_select(idx):
+            if idx < 0:
+                return
+            match = matches[idx]
+
+            def jump(vbuff):
+                region = sublime.Region(match.offset, match.offset + len(query))
+                vbuff.view.sel().clear()
+                vbuff.view.sel().add(region)
+                vbuff.view.show_at_center(region)
+                self.window.focus_view(vbuff.view)
+
+            vbuff = vws.buff_by_id(match.buffer)
+            if vbuff is not None:
+                jump(vbuff)
+            else:
+                attach_buffer(self.window, vws, match.buffer, then=jump)
+
+        self.window.show_quick_panel(items, on_select)
+
+    def input_description(self) -> str:
+        return "Search: "
+
+    def input(self, args):
+        if "workspace_id" not in args:
+            return ActiveWorkspacesIdList(self.window, text_inputs=(("query", ""),))
+
+        if "query" not in args:
+            return SimpleTextInput(("query", ""))
+
+
+class CodempFollowUserCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return len(client.all_workspaces(self.window)) > 0
+
+    def run(self, workspace_id, user):  # pyright: ignore[reportIncompatibleMethodOverride]
+        vws = client.workspace_from_id(workspace_id)
+        if vws is None:
+            sublime.error_message(
+                f"You are not attached to the workspace '{workspace_id}'"
+            )
+            return
+
+        Follower(client, vws, self.window, user).start()
+
+    def input_description(self) -> str:
+        return "Follow: "
+
+    def input(self, args):
+        if "workspace_id" not in args:
+            return ActiveWorkspacesIdList(self.window, user_list=True)
+
+
+class CodempStopFollowingCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return any(vws.follower for vws in client.all_workspaces(self.window))
+
+    def run(self):
+        for vws in client.all_workspaces(self.window):
+            if vws.follower is not None:
+                vws.follower.stop()
+
+
+class CodempReplaceWorkspaceCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return len(client.all_workspaces(self.window)) > 0
+
+    def run(self, workspace_id, find, replace, regex=False):  # pyright: ignore[reportIncompatibleMethodOverride]
+        vws = client.workspace_from_id(workspace_id)
+        if vws is None:
+            sublime.error_message(
+                f"You are not attached to the workspace '{workspace_id}'"
+            )
+            return
+        if not find:
+            return
+        if regex:
+            try:
+                re.compile(find)
+            except re.error as e:
+                sublime.error_message(f"Invalid regular expression '{find}':\n{e}")
+                return
+
+        if not sublime.ok_cancel_dialog(
+            f"Replace every '{find}' with '{replace}' in all the buffers "
+            f"of '{workspace_id}'?",
+            ok_title="replace",
+            title="Replace in Workspace?",
+        ):
+            return
+
+        def progress(done, total):
+            self.window.status_message(f"[codemp] replacing '{find}': {done}/{total}")
+
+        def deferred_replace():
+            report = replace_in_workspace(vws, find, replace, regex, progress)
+            logger.info(f"'{find}' -> '{replace}' in '{workspace_id}': {report}")
+            self.window.status_message(f"[codemp] {report}")
+
+        in_background("replace", deferred_replace)
+
+    def input_description(self) -> str:
+        return "Replace in: "
+
+    def input(self, args):
+        if "workspace_id" not in args:
+            return ActiveWorkspacesIdList(
+                self.window, text_inputs=(("find", ""), ("replace", ""))
+            )
+
+        if "find" not in args:
+            return SimpleTextInput(("find", ""), ("replace", ""))
+
+        if "replace" not in args:
+            return SimpleTextInput(("replace", ""))
+
+
+class CodempExportWorkspaceCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return len(client.all_workspaces(self.window)) > 0
+
+    def run(self, workspace_id, directory=None, incremental=True):  # pyright: ignore[reportIncompatibleMethodOverride]
+        vws = client.workspace_from_id(workspace_id)
+        if vws is None:
+            sublime.error_message(
+                f"You are not attached to the workspace '{workspace_id}'"
+            )
+            return
+
+        if directory is None:
+            sublime.select_folder_dialog(
+                lambda d: d and self.run(workspace_id, d, incremental)
+            )
+            return
+
+        def deferred_export():
+            sublime.status_message(f"[codemp] exporting '{workspace_id}'...")
+            try:
+                report = export_workspace(vws, directory, incremental)
+            except OSError as e:
+                logger.error(f"export of '{workspace_id}' failed: {e}")
+                sublime.error_message(f"Could not export '{workspace_id}':\n{e}")
+                return
+            logger.info(f"'{workspace_id}' -> '{directory}': {report}")
+            sublime.status_message(f"[codemp] {report}")
+
+        in_background("export", deferred_export)
+
+    def input_description(self) -> str:
+        return "Export: "
+
+    def input(self, args):
+        if "workspace_id" not in args:
+            return ActiveWorkspacesIdList(self.window)
+
+
+class CodempShareFolderCommand(sublime_plugin.WindowCommand):
+    def is_enabled(self):
+        return len(client.all_workspaces(self.window)) > 0
+
+    def run(self, workspace_id, directory=None):  # pyright: ignore[reportIncompatibleMethodOverride]
+        vws = client.workspace_from_id(workspace_id)
+        if vws is None:
+            sublime.error_message(
+                f"You are not attached to the workspace '{workspace_id}'"
+            )
+            return
+
+        if directory is None:
+            sublime.select_folder_dialog(lambda d: d and self.run(workspace_id, d))
+            return
+
+        def progress(done, total):
+            self.window.status_message(f"[codemp] sharing '{directory}': {done}/{total}")
+
+        def deferred_share():
+            report = share_folder(vws, directory, progress)
+            logger.info(f"'{directory}' -> '{workspace_id}': {report}")
+            self.window.status_message(f"[codemp] {report}")
+
+        in_background("share", deferred_share)
+
+    def input_description(self) -> str:
+        return "Share Folder: "
+
+    def input(self, args):
+        if "workspace_id" not in args:
+            return ActiveWorkspacesIdList(self.window)